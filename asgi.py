@@ -0,0 +1,47 @@
+"""Production ASGI entry point, e.g.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080 --workers 4
+
+POST /<project_id>/api_count is answered directly on the event loop: the call is
+appended to the api counter and the response is sent, with no db or lock work on
+the request path. Every other route is served by the Flask app.
+When running several workers, set API_COUNT_BACKEND=postgres."""
+import json
+from asgiref.wsgi import WsgiToAsgi
+from payment_processor import create_app, api_counter
+
+flask_app = WsgiToAsgi(create_app())
+
+
+# returns the start and body messages of the api_count response, the same as the flask route's
+def api_count_response(count):
+    body = json.dumps({'result': 'updated count {}'.format(count), 'error': 0}).encode()
+    start = {
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(body)).encode())]
+    }
+    return start, {'type': 'http.response.body', 'body': body}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        parts = scope['path'].split('/')
+        if len(parts) == 3 and parts[1] and parts[2] == 'api_count':
+            start, body = api_count_response(api_counter.increment(parts[1]))
+            await send(start)
+            await send(body)
+            return
+    await flask_app(scope, receive, send)
@@ -0,0 +1,73 @@
+"""Measures /<project_id>/api_count throughput of the Flask development server
+(python3 payment_processor.py) and of the ASGI entry point (uvicorn asgi:app).
+
+Starts each server on localhost, fires --requests POSTs with --concurrency requests
+in flight and prints requests per second. Needs the DB_* database, like the servers:
+
+    python3 -m benchmarks.api_count_throughput --requests 20000 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import aiohttp
+
+servers = {
+    'flask dev server': [sys.executable, '-c', "from payment_processor import app; app.run(host='127.0.0.1', port={port})"],
+    'uvicorn asgi:app': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', '{port}',
+                         '--log-level', 'warning', '--no-access-log'],
+}
+
+
+async def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            try:
+                async with session.post(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f'server at {url} did not start')
+
+
+async def fire(url, requests, concurrency):
+    remaining = iter(range(requests))
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def worker():
+            for _ in remaining:
+                async with session.post(url) as response:
+                    await response.read()
+                    assert response.status == 200
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return requests / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--port', type=int, default=8091)
+    args = parser.parse_args()
+
+    url = f'http://127.0.0.1:{args.port}/bench-project/api_count'
+    env = dict(os.environ, LOGLEVEL='WARNING')
+    results = {}
+    for name, command in servers.items():
+        process = subprocess.Popen([part.format(port=args.port) for part in command], env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_until_up(url))
+            results[name] = asyncio.run(fire(url, args.requests, args.concurrency))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f'{args.requests} requests, {args.concurrency} concurrent')
+    for name, rate in results.items():
+        print(f'{name:<20}{rate:>10.0f} req/s')
@@ -0,0 +1,94 @@
+"""Times the payment lookup queries of the payment processing loops on a generated
+payment table, before and after adding the indexes from migrate_db.py.
+
+Runs against the database configured by DB_HOST/DB_USERNAME/DB_PASSWORD/DB_DATABASE,
+inside a throwaway bench_indexes schema that is dropped afterwards:
+
+    python3 -m benchmarks.db_indexes --payments 100000
+"""
+import argparse
+import hashlib
+import statistics
+import time
+import psycopg2 as db
+from migrate_db import host, user, password, database, add_index, payment_indexes
+
+schema = 'bench_indexes'
+
+queries = {
+    'payment by address': "SELECT id FROM payment WHERE eth_address = %(address)s",
+    'payment by project': "SELECT id FROM payment WHERE project = %(project)s",
+    'registry delta': ("SELECT p.id, p.eth_address, p.project, pr.active, p.pending, p.quote_start_time, p.min_amount_eth, p.amount_eth "
+                       "FROM payment p JOIN project pr ON pr.name = p.project "
+                       "WHERE p.eth_address <> '' AND (p.id > %(max_id)s OR p.quote_start_time > now() - interval '1 minute')"),
+    'expired pending quotes': "SELECT id FROM payment WHERE pending = true AND quote_start_time < now() - interval '1 hour'",
+}
+
+
+def populate(cursor, payments):
+    cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {schema}')
+    cursor.execute(f'SET search_path TO {schema}')
+    cursor.execute('CREATE TABLE project (LIKE public.project INCLUDING DEFAULTS, PRIMARY KEY (name))')
+    cursor.execute('CREATE TABLE payment (LIKE public.payment INCLUDING DEFAULTS, PRIMARY KEY (id))')
+    cursor.execute('CREATE INDEX idx_payment__project ON payment (project)') # created by pony on the real table
+    cursor.execute('''INSERT INTO project (name, api_key, api_token_count, used_api_tokens, active, xquery, hydra)
+                      SELECT 'project-' || i, md5(i::text), 6000, 0, i %% 10 = 0, true, false FROM generate_series(1, %(n)s) i''',
+                   {'n': payments})
+    # ~1% pending quotes spread over the last hour, ~10% auto activated projects without deposit addresses
+    cursor.execute('''INSERT INTO payment (id, pending, eth_token, eth_address, eth_privkey, avax_token, avax_address, avax_privkey,
+                                           nevm_token, nevm_address, nevm_privkey, tx_hash, min_amount_eth, amount_eth, quote_start_time, project)
+                      SELECT i, i %% 100 = 0, md5(i::text) || md5(i::text),
+                             CASE WHEN i %% 10 = 0 THEN '' ELSE '0x' || substr(md5('eth' || i), 1, 40) END, md5(i::text) || md5(i::text),
+                             md5(i::text) || md5(i::text),
+                             CASE WHEN i %% 10 = 0 THEN '' ELSE '0x' || substr(md5('avax' || i), 1, 40) END, md5(i::text) || md5(i::text),
+                             md5(i::text) || md5(i::text),
+                             CASE WHEN i %% 10 = 0 THEN '' ELSE '0x' || substr(md5('nevm' || i), 1, 40) END, md5(i::text) || md5(i::text),
+                             '', 0.01, 0,
+                             CASE WHEN i %% 100 = 0 THEN now() - (i %% 120 || ' minutes')::interval ELSE now() - (i || ' minutes')::interval END,
+                             'project-' || i
+                      FROM generate_series(1, %(n)s) i''', {'n': payments})
+    cursor.execute('ANALYZE')
+
+
+def time_queries(cursor, params, runs):
+    timings = {}
+    for name, sql in queries.items():
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+        timings[name] = statistics.median(samples)
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payments', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    conn = db.connect(host=host, database=database, user=user, password=password)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        print(f'generating {args.payments} payments...')
+        populate(cursor, args.payments)
+        params = {'address': '0x' + hashlib.md5(f'eth{args.payments // 2 + 1}'.encode()).hexdigest()[:40],
+                  'project': f'project-{args.payments // 2}',
+                  'max_id': args.payments}
+        before = time_queries(cursor, params, args.runs)
+        for name, columns, where in payment_indexes:
+            add_index(f'{schema}.payment', name, columns, where)
+        cursor.execute('ANALYZE')
+        after = time_queries(cursor, params, args.runs)
+
+        print(f'\nmedian of {args.runs} runs on {args.payments} payments (ms)')
+        print(f'{"query":<24}{"no indexes":>12}{"indexes":>12}')
+        for name in queries:
+            print(f'{name:<24}{before[name]:>12.3f}{after[name]:>12.3f}')
+    finally:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        conn.close()
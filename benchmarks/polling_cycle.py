@@ -0,0 +1,247 @@
+"""Measures the payment polling cycle (fetch_evm_accounts + handle_evm_event) of the
+eth chain on synthetic populations of deposit addresses, without a real node.
+
+Each population runs in its own process against:
+- a local stand-in chain: eth-tester (py-evm) served over JSON-RPC http from a child
+  process, with the test ERC20 from test_contracts/ deployed as aBLOCK
+- the database configured by DB_HOST/DB_USERNAME/DB_PASSWORD/DB_DATABASE, inside a
+  throwaway bench_cycle schema holding copies of its tables, indexes included, that is
+  dropped afterwards
+
+Every population runs three cycles:
+- cold: first cycle after a start, every address is polled and the funded ones credited
+- quiet: a new empty block, nothing paid
+- deposits: --deposits pending addresses paid in eth and aBLOCK
+
+and reports the wall time, the cpu time of the processor process (its own share of
+the wall time, without waiting on the chain and db), JSON-RPC calls (and http requests carrying
+them), db queries and peak RSS of the processor process after each cycle:
+
+    python3 -m benchmarks.polling_cycle --addresses 1000 10000 100000
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+schema = 'bench_cycle'
+eth_amount = 5*10**16 # wei sent to a paid address, 0.05 eth
+ablock_amount = 5*10**8 # aBLOCK sent to a paid address, 5 aBLOCK (8 decimals)
+
+
+# returns the deposit address of generated payment i, as generated by populate
+def deposit_address(i):
+    digest = hashlib.md5(f'eth{i}'.encode()).hexdigest()
+    return '0x' + (digest + digest)[:40]
+
+
+def run_chain(conn, requests, calls):
+    """Serves an eth-tester chain over JSON-RPC http until killed. Sends (port, aBLOCK
+    address) over conn once ready, then executes ('pay', addresses) and ('mine', n)
+    commands from conn, replying with the new block number."""
+    from web3 import Web3, EthereumTesterProvider
+    from eth.vm.spoof import SpoofTransaction
+
+    w3 = Web3(EthereumTesterProvider())
+    lock = threading.Lock()
+    # eth-tester signs every eth_call with its pure python secp256k1 (~30 ms a call) where a node just
+    # executes it, so run calls as spoofed unsigned transactions to keep the chain out of the measurements
+    backend = w3.provider.ethereum_tester.backend
+    call = backend.call
+
+    def unsigned_call(transaction, block_number='latest'):
+        backend._get_normalized_and_signed_evm_transaction = lambda transaction, block_number: SpoofTransaction(
+            backend._get_normalized_and_unsigned_evm_transaction(transaction, block_number), from_=transaction['from'])
+        try:
+            return call(transaction, block_number)
+        finally:
+            del backend._get_normalized_and_signed_evm_transaction
+
+    backend.call = unsigned_call
+    with open('test_contracts/compiled.json') as file:
+        erc20 = json.load(file)['ERC20']
+    owner = w3.eth.accounts[0]
+    receipt = w3.eth.wait_for_transaction_receipt(
+        w3.eth.contract(abi=erc20['abi'], bytecode=erc20['bytecode']).constructor('aBLOCK', 8, 10**18).transact({'from': owner}))
+    token = w3.eth.contract(address=receipt.contractAddress, abi=erc20['abi'])
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive, like a real node
+        wbufsize = 65536 # one write per response
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            batch = isinstance(body, list)
+            replies = []
+            with lock:
+                requests.value += 1
+                calls.value += len(body) if batch else 1
+                for call in body if batch else [body]:
+                    try:
+                        result = w3.manager.request_blocking(call['method'], call.get('params', []))
+                        # quantities go back hex encoded, as a node sends them
+                        reply = {'result': hex(result) if type(result) is int else json.loads(Web3.toJSON(result))}
+                    except Exception as e:
+                        reply = {'error': {'code': -32000, 'message': str(e)}}
+                    reply.update({'jsonrpc': '2.0', 'id': call.get('id')})
+                    replies.append(reply)
+            data = json.dumps(replies if batch else replies[0]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send((server.server_address[1], token.address))
+    while True:
+        command, arg = conn.recv()
+        with lock:
+            if command == 'pay':
+                for address in arg:
+                    w3.eth.send_transaction({'from': owner, 'to': Web3.toChecksumAddress(address), 'value': eth_amount})
+                    token.functions.transfer(Web3.toChecksumAddress(address), ablock_amount).transact({'from': owner})
+            elif command == 'mine':
+                w3.provider.ethereum_tester.mine_blocks(arg)
+            conn.send(w3.eth.block_number)
+
+
+# creates empty copies of the public tables in the throwaway schema, with their own id sequences.
+# Pony only looks for its tables in public, so it finds them and leaves the schema alone.
+def create_tables(cursor):
+    cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {schema}')
+    cursor.execute("SELECT tablename FROM pg_catalog.pg_tables WHERE schemaname = 'public'")
+    for table, in cursor.fetchall():
+        cursor.execute(f'CREATE TABLE {schema}.{table} (LIKE public.{table} INCLUDING DEFAULTS INCLUDING INDEXES)')
+    cursor.execute("SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = %s AND column_default LIKE 'nextval%%'",
+                   (schema,))
+    for table, column in cursor.fetchall():
+        cursor.execute(f'CREATE SEQUENCE {schema}.{table}_{column}_seq OWNED BY {schema}.{table}.{column}')
+        cursor.execute(f"ALTER TABLE {schema}.{table} ALTER COLUMN {column} SET DEFAULT nextval('{schema}.{table}_{column}_seq')")
+
+
+def populate(db, addresses):
+    """Generates one project and payment per deposit address: every 100th payment has
+    a pending quote from the last hour, every 10th project is active, the other quotes
+    are spread one minute apart into the past."""
+    db.execute('''INSERT INTO project (name, api_key, api_token_count, used_api_tokens, active, activated, xquery, hydra)
+                  SELECT 'project-' || i, md5(i::text), 0, 0, mod(i, 10) = 0, mod(i, 10) = 0, true, false
+                  FROM generate_series(1, $addresses) i''')
+    db.execute('''INSERT INTO payment (pending, eth_token, eth_address, eth_privkey, avax_token, avax_address, avax_privkey,
+                                       nevm_token, nevm_address, nevm_privkey, tx_hash,
+                                       min_amount_eth, min_amount_ablock, amount_eth, amount_ablock,
+                                       min_amount_eth_raw, min_amount_ablock_raw, amount_eth_raw, amount_ablock_raw, quote_start_time, project)
+                  SELECT mod(i, 100) = 0, '', '0x' || substr(md5('eth' || i) || md5('eth' || i), 1, 40), '', '', '', '', '', '', '', '',
+                         0.01, 1.0, 0, 0, 10000000000000000, 100000000, 0, 0,
+                         CASE WHEN mod(i, 100) = 0 THEN now() - (mod(i, 60) || ' minutes')::interval
+                              ELSE now() - (i || ' minutes')::interval END,
+                         'project-' || i
+                  FROM generate_series(1, $addresses) i''')
+
+
+def run_population(addresses, deposits, multicall, results):
+    import psycopg2
+    from migrate_db import host, user, password, database
+
+    conn = psycopg2.connect(host=host, database=database, user=user, password=password)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    create_tables(cursor)
+    requests, calls = multiprocessing.Value('l', 0), multiprocessing.Value('l', 0)
+    chain_conn, child_conn = multiprocessing.Pipe()
+    chain = multiprocessing.Process(target=run_chain, args=(child_conn, requests, calls), daemon=True)
+    chain.start()
+    try:
+        port, token_address = chain_conn.recv()
+        # every connection of this process, pony's included, uses the throwaway schema
+        os.environ['PGOPTIONS'] = f'-c search_path={schema}'
+        os.environ.update({'ETH_HOST': '127.0.0.1', 'ETH_PORT': str(port), 'ETH_HOST_TYPE': 'http'})
+        for evm in ['avax', 'nevm']:
+            os.environ[f'{evm.upper()}_HOST'] = ''
+
+        from database.models import db, db_session
+        import util.eth_payments as eth_payments
+        from util.multicall import multicall_abi
+
+        with db_session:
+            populate(db, addresses)
+        cursor.execute(f'ANALYZE {schema}.payment, {schema}.project')
+
+        def chain_command(command, arg):
+            chain_conn.send((command, arg))
+            return chain_conn.recv()
+
+        # ~0.1% of the addresses already paid before the processor starts, confirmed by the time it polls them
+        paid = [deposit_address(i) for i in range(1, addresses + 1, 1000)]
+        chain_command('pay', paid)
+        chain_command('mine', eth_payments.confirmations['eth'] + 1)
+
+        eth_payments.block_contract_address['eth'] = token_address
+        helper = eth_payments.Web3Helper()
+        if multicall:
+            with open('test_contracts/compiled.json') as file:
+                compiled = json.load(file)['Multicall3']
+            w3 = helper.w3['eth']
+            receipt = w3.eth.wait_for_transaction_receipt(
+                w3.eth.contract(abi=compiled['abi'], bytecode=compiled['bytecode']).constructor().transact({'from': w3.eth.accounts[0]}))
+            helper.multicall['eth'] = w3.eth.contract(address=receipt.contractAddress, abi=multicall_abi)
+            chain_command('mine', eth_payments.confirmations['eth'] + 1)
+
+        def cycle(name):
+            start_requests, start_calls = requests.value, calls.value
+            start_queries = db.local_stats[None].db_count
+            start, start_cpu = time.perf_counter(), time.process_time()
+            helper.fetch_evm_accounts('eth')
+            helper.handle_evm_event('eth')
+            results.put((addresses, name, time.perf_counter() - start, time.process_time() - start_cpu, calls.value - start_calls, requests.value - start_requests,
+                         db.local_stats[None].db_count - start_queries, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+        cycle('cold')
+        chain_command('mine', 1)
+        cycle('quiet')
+        chain_command('pay', [deposit_address(i) for i in range(100, 100*deposits + 1, 100)]) # pending quotes, polled every cycle
+        chain_command('mine', eth_payments.confirmations['eth'] + 1)
+        cycle('deposits')
+    finally:
+        chain.kill()
+        cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--addresses', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--deposits', type=int, default=10, help='addresses paid before the deposits cycle')
+    parser.add_argument('--multicall', action='store_true', help='read balances through a deployed Multicall3')
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    rows = []
+    for addresses in args.addresses:
+        print(f'running {addresses} addresses...')
+        # a fresh process per population, so module state and peak memory don't carry over
+        worker = multiprocessing.Process(target=run_population, args=(addresses, args.deposits, args.multicall, results))
+        worker.start()
+        worker.join()
+        while True:
+            try:
+                rows.append(results.get(timeout=1))
+            except queue.Empty:
+                break
+        if worker.exitcode != 0:
+            raise SystemExit(f'{addresses} addresses run failed')
+
+    print(f'\n{"addresses":>10}{"cycle":>10}{"wall (s)":>10}{"cpu (s)":>10}{"rpc calls":>11}{"http reqs":>11}{"db queries":>12}{"peak rss (MB)":>15}')
+    for addresses, name, wall, cpu, rpc_calls, http_requests, queries, rss in rows:
+        print(f'{addresses:>10}{name:>10}{wall:>10.2f}{cpu:>10.2f}{rpc_calls:>11}{http_requests:>11}{queries:>12}{rss:>15.1f}')
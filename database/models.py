@@ -1,4 +1,5 @@
 from datetime import datetime
+from decimal import Decimal
 from pony.orm import *
 from database.db import db
 
@@ -53,7 +54,45 @@ class Payment(db.Entity):
     amount_sysblock = Optional(float)
     quote_start_time = Required(datetime)
 
+    # min and credited amounts in integer base units of the coin (wei for evm native coins, see util/units.py), used for crediting;
+    # numeric(78, 0) holds any uint256. The float amounts above are kept for api responses
+    min_amount_eth_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    min_amount_ablock_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    min_amount_avax_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    min_amount_aablock_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    min_amount_sys_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    min_amount_sysblock_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    amount_eth_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    amount_ablock_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    amount_avax_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    amount_aablock_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    amount_sys_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+    amount_sysblock_raw = Optional(Decimal, sql_type='numeric(78, 0)')
+
     project = Required(Project, reverse='payments')
 
 
+class ChainCursor(db.Entity):
+    name = PrimaryKey(str) # e.g. eth_transfer_logs, or the evm name for the chain's processing checkpoint
+    block_number = Required(int, size=64) # last block scanned/processed
+    block_hash = Optional(str) # hash of block_number, checked against the chain to detect reorgs
+    updated = Optional(datetime)
+
+
+class ApiUsage(db.Entity):
+    project = Required(str) # project name, not a foreign key so unknown projects can be recorded and dropped at rollup
+    calls = Required(int, size=64)
+
+
+class DepositKey(db.Entity):
+    address = Required(str)
+    privkey = Required(str) # encrypted, see util/key_pool.py
+
+
+class CoinPrice(db.Entity):
+    coin = PrimaryKey(str)
+    price = Required(float) # usd
+    updated = Required(float) # unix time the price was fetched, by the leader process, see util/shared_prices.py
+
+
 db.generate_mapping(create_tables=True)
@@ -61,6 +61,27 @@ def change_type(table, name, data_type):
 	except Exception as e:
 		print(f'ALTER COLUMN TYPE {table} {name} {data_type}\n{e}')
 
+def add_index(table, name, columns, where=None):
+	try:
+		conn = db.connect(host=host, database=database, user=user, password=password)
+		conn.autocommit = True
+		cursor = conn.cursor()
+		where_clause = f' WHERE {where}' if where else ''
+		cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns}){where_clause}')
+		conn.close()
+		print(f'ADD INDEX {table} - {name} ({columns}){where_clause}')
+	except Exception as e:
+		print(f'ADD INDEX {table} {name}\n{e}')
+
+# (name, columns, where) of the indexes on the payment table used by the payment processing loops
+payment_indexes = [
+	('idx_payment__eth_address', 'eth_address', "eth_address <> ''"),
+	('idx_payment__avax_address', 'avax_address', "avax_address <> ''"),
+	('idx_payment__nevm_address', 'nevm_address', "nevm_address <> ''"),
+	('idx_payment__quote_start_time', 'quote_start_time', None),
+	('idx_payment__pending', 'quote_start_time', 'pending = true'),
+]
+
 
 if __name__ == '__main__':
 
@@ -134,3 +155,14 @@ if __name__ == '__main__':
 
 	rename_column('payment','amount_wsys', 'amount_sys')
 	rename_column('payment','min_amount_wsys','min_amount_sys')
+
+	add_column('chaincursor','block_hash', 'text')
+	add_column('chaincursor','updated', 'timestamp')
+
+	for coin_name in ['eth', 'ablock', 'avax', 'aablock', 'sys', 'sysblock']:
+		add_column('payment', f'min_amount_{coin_name}_raw', 'numeric(78, 0)')
+		add_column('payment', f'amount_{coin_name}_raw', 'numeric(78, 0)')
+
+	# payment.project is already indexed by pony (idx_payment__project)
+	for name, columns, where in payment_indexes:
+		add_index('payment', name, columns, where)
@@ -6,13 +6,21 @@ import time
 import uuid
 import secrets
 import datetime
-from threading import Thread
+import atexit
+from threading import Thread, Lock
 from flask import Flask, request, Response, g, jsonify
 from database.models import commit, db_session, select, Project, Payment
 from util.eth_payments import Web3Helper, coin_names
-from util import get_eth_amount, get_sys_amount, get_avax_amount, get_ablock_amount, get_aablock_amount, get_sysblock_amount, \
-                 min_payment_amount_tier1, min_payment_amount_tier2, min_payment_amount_xquery, discount_ablock, discount_aablock, \
-                 discount_sysblock, min_api_calls, quote_valid_hours
+from util.quote_expiry import QuoteExpiry
+from util.api_counter import ApiCounter
+from util.leader import run_as_leader
+from util.chain_workers import ChainSupervisor, chain_workers
+from util.quote_table import QuoteCache
+from util import metrics
+from util.metrics import db_session_seconds
+from util.units import coin_decimals, to_raw
+from util.shared_prices import save_prices, load_prices
+from util import price_oracle, min_payment_amount_tier1, min_payment_amount_tier2, min_payment_amount_xquery, min_api_calls, quote_valid_hours
 
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
 logging.basicConfig(level=LOGLEVEL, stream=sys.stdout,
@@ -20,66 +28,100 @@ logging.basicConfig(level=LOGLEVEL, stream=sys.stdout,
                     datefmt='[%Y-%m-%d:%H:%M:%S]')
 
 web3_helper = Web3Helper()
-api_count_cache = dict()
+quote_expiry = QuoteExpiry()
+api_counter = ApiCounter()
+quote_cache = QuoteCache(coin_names, web3_helper.HOST)
+create_project_seconds = metrics.Histogram('create_project_seconds', 'Latency of /create_project and /extend_project requests')
+metrics.Gauge('price_age_seconds', 'Seconds since each coin price was last refreshed',
+              lambda: {(coin_name,): time.time() - refreshed for coin_name, refreshed in price_oracle.current.times.items()}, ['coin'])
+metrics.Gauge('api_count_buffer_size', 'Api calls counted by this process and not yet flushed to the db',
+              lambda: {(): len(api_counter.calls) + sum(api_counter.unflushed.values())})
+metrics.Gauge('api_count_flush_lag_seconds', 'Seconds since the last successful api count flush of this process',
+              lambda: {(): time.time() - api_counter.flushed})
+startup_lock = Lock()
+started = False
 
 def update_api_counts():
     """Periodically updates the api counts to the db. Should be called
     from a unique thread."""
     while True:
-        global api_count_cache
-        if api_count_cache:
-            try:
-                with db_session:
-                    for project_id in api_count_cache:
-                        proj = Project.get(name=project_id)
-                        if not proj:
-                            continue
-                        count = api_count_cache[project_id]
-                        if not count or not isinstance(count, int):
-                            count = 0
-                        proj.used_api_tokens += count
-                        if proj.used_api_tokens >= proj.api_token_count:
-                            proj.active = False
-                        logging.info('updating {} with {}'.format(proj.name, count))
-                api_count_cache = dict()  # clear cache on success
-            except Exception as e:
-                logging.error(e)
+        try:
+            api_counter.flush()
+        except Exception as e:
+            logging.error(e)
         time.sleep(5)
 
-def on_startup():
-    evm_threads = {}
-    for evm in coin_names:
-        logging.info(f'Starting {evm} blockchain payment processing thread...')
-        evm_threads[evm] = Thread(target=web3_helper.evm_start, daemon=True, args=[evm])
-        evm_threads[evm].start()
+def start_payment_processing():
+    # the leader queries the price sources for every process of the deployment
+    price_oracle.follow = None
+    price_oracle.publish = save_prices
+    if chain_workers:
+        logging.info('Starting chain worker supervisor...')
+        supervisor = ChainSupervisor([evm for evm in coin_names if web3_helper.HOST_TYPE[evm] != ''])
+        Thread(target=supervisor.run, daemon=True).start()
+        atexit.register(supervisor.stop)
+    else:
+        evm_threads = {}
+        for evm in coin_names:
+            logging.info(f'Starting {evm} blockchain payment processing thread...')
+            evm_threads[evm] = Thread(target=web3_helper.evm_start, daemon=True, args=[evm])
+            evm_threads[evm].start()
+    logging.info('Starting quote expiry thread...')
+    Thread(target=quote_expiry.run, daemon=True).start()
+    if web3_helper.key_pool.enabled():
+        logging.info('Starting deposit key pool thread...')
+        Thread(target=web3_helper.key_pool.run, daemon=True).start()
+
+def on_startup(leader_election=False):
+    """Starts the background threads once per process. Every process flushes its
+    own api counts; with leader_election, the payment processing threads only run
+    in the one process of the deployment holding the leader lock, which also
+    refreshes the prices that the other processes read from the db."""
+    global started
+    with startup_lock:
+        if started:
+            return
+        started = True
+    if leader_election:
+        price_oracle.follow = load_prices # until this process becomes leader
+    if metrics.metrics_dir:
+        Thread(target=metrics.run_writer, daemon=True).start()
+    logging.info('Starting price oracle thread...')
+    Thread(target=price_oracle.run, daemon=True).start()
     t = Thread(target=update_api_counts, daemon=True)
     t.start()
-
-def get_min_amounts(auto_activate, xquery_bool, archive_mode_bool, amounts):
-
-    min_amount = {}
-    for evm in coin_names:
-        for native_block_ in [True, False]:
-            coin_name = coin_names[evm][native_block_]
-            discount = eval(f'discount_{coin_name}') if not native_block_ else 1
-            if auto_activate:
-                min_amount[coin_name] = 0
-                min_amount['usd'] = 0
-                min_amount[f'{coin_name}_usd'] = 0
-            elif xquery_bool:
-                min_amount[coin_name] = amounts[f'xquery_min_amount_{coin_name}']
-                min_amount['usd'] = min_payment_amount_xquery
-                min_amount[f'{coin_name}_usd'] = min_payment_amount_xquery*discount
-            elif archive_mode_bool:
-                min_amount[coin_name] = amounts[f'tier2_min_amount_{coin_name}']
-                min_amount['usd'] = min_payment_amount_tier2
-                min_amount[f'{coin_name}_usd'] = min_payment_amount_tier2*discount
-            else:
-                min_amount[coin_name] = amounts[f'tier1_min_amount_{coin_name}']
-                min_amount['usd'] = min_payment_amount_tier1
-                min_amount[f'{coin_name}_usd'] = min_payment_amount_tier1*discount
-
-    return min_amount
+    if leader_election:
+        Thread(target=run_as_leader, daemon=True, args=[start_payment_processing]).start()
+    else:
+        start_payment_processing()
+
+def create_app():
+    """App factory for production WSGI servers, e.g.
+    gunicorn --workers 4 'payment_processor:create_app()'"""
+    on_startup(leader_election=True)
+    return app
+
+# returns the quote table tier of a project
+def get_tier(auto_activate, xquery_bool, archive_mode_bool):
+    if auto_activate:
+        return 'free'
+    elif xquery_bool:
+        return 'xquery'
+    elif archive_mode_bool:
+        return 'tier2'
+    return 'tier1'
+
+# returns the project specific fields of a create/extend response
+def get_project_fields(project, payment):
+    return {
+        'project_id': project.name,
+        'api_key': project.api_key,
+        'payment_eth_address': payment.eth_address,
+        'payment_avax_address': payment.avax_address,
+        'payment_nevm_address': payment.nevm_address,
+        'quote_start_time': payment.quote_start_time.strftime("%Y-%m-%d %H:%M:%S UTC"),
+        'quote_expiry_time': (payment.quote_start_time + datetime.timedelta(hours=quote_valid_hours)).strftime("%Y-%m-%d %H:%M:%S UTC")
+    }
 
 class FlaskWithStartUp(Flask):
     def run(self, host=None, port=None, debug=None, load_dotenv=True, **options):
@@ -95,19 +137,14 @@ app = FlaskWithStartUp(__name__)
 
 @app.route("/create_project", methods=['POST'])
 @app.route("/extend_project/<project_id>", methods=['POST'])
+@create_project_seconds.time()
 def create_or_extend_project(project_id=None):
 
-    # fetch min payment amounts
-    amounts = {}
-    for evm in coin_names:
-        for native_block_ in [True, False]:
-            coin_name = coin_names[evm][native_block_]
-            discount = eval(f'discount_{coin_name}') if not native_block_ else 1
-            amounts[f'tier1_min_amount_{coin_name}'] = eval(f'get_{coin_name}_amount(min_payment_amount_tier1*discount)') if web3_helper.HOST[evm] != '' else None
-            amounts[f'tier2_min_amount_{coin_name}'] = eval(f'get_{coin_name}_amount(min_payment_amount_tier2*discount)') if web3_helper.HOST[evm] != '' else None
-            amounts[f'xquery_min_amount_{coin_name}'] = eval(f'get_{coin_name}_amount(min_payment_amount_xquery*discount)') if web3_helper.HOST[evm] != '' else None
-
-    if len(amounts) - list(amounts.values()).count(None) < 1:
+    # fetch min payment amounts of the current price snapshot
+    quotes = quote_cache.table()
+    amounts = quotes.amounts
+
+    if not quotes.available():
         context = {
             'error': 'Internal Server Error: Failed to get at least 1 payment amount, please try again',
             'amounts':amounts
@@ -157,13 +194,15 @@ def create_or_extend_project(project_id=None):
                 else min_payment_amount_tier1 == 0
 
         # Fetch min amounts to be paid to activate a project
-        min_amount = get_min_amounts(auto_activate, xquery_bool, archive_mode_bool, amounts)
+        tier = get_tier(auto_activate, xquery_bool, archive_mode_bool)
+        min_amount = quotes.min_amounts[tier]
 
 
         token = secrets.token_hex(32)
-        eth_address, eth_privkey = web3_helper.get_evm_address('eth', token)
-        avax_address, avax_privkey = web3_helper.get_evm_address('avax', token)
-        nevm_address, nevm_privkey = web3_helper.get_evm_address('nevm', token)
+        deposit_keys = web3_helper.get_evm_addresses()
+        eth_address, eth_privkey = deposit_keys['eth']
+        avax_address, avax_privkey = deposit_keys['avax']
+        nevm_address, nevm_privkey = deposit_keys['nevm']
         project_id = str(uuid.uuid4())
         api_key = secrets.token_urlsafe(32)
 
@@ -176,7 +215,7 @@ def create_or_extend_project(project_id=None):
             return Response(response=json.dumps(context))
 
         try:
-            with db_session:
+            with db_session_seconds.time('create_project'), db_session:
                 project = Project(
                     name=project_id,
                     api_key=api_key,
@@ -218,9 +257,14 @@ def create_or_extend_project(project_id=None):
                     amount_avax=0,
                     amount_aablock=0,
                     amount_sys=0,
-                    amount_sysblock=0
+                    amount_sysblock=0,
+                    **{f'min_amount_{coin}_raw': to_raw(min_amount[coin], coin) for coin in coin_decimals},
+                    **{f'amount_{coin}_raw': 0 for coin in coin_decimals}
                 )
                 commit()
+                if payment.pending:
+                    quote_expiry.schedule(payment.id, payment.quote_start_time)
+                fields = get_project_fields(project, payment)
 
         except Exception as e:
             logging.critical('Exception while creating Project or Payment', exc_info=True)
@@ -242,7 +286,7 @@ def create_or_extend_project(project_id=None):
 
         logging.info(f'Extending project: {project_id}')
         try:
-            with db_session:
+            with db_session_seconds.time('extend_project'), db_session:
                 project = Project.get(name=project_id)
                 payment = Payment.get(project=project_id)
                 if not project or not payment:
@@ -259,7 +303,8 @@ def create_or_extend_project(project_id=None):
                 auto_activate = False
 
                 # Fetch min amounts to be paid to activate a project
-                min_amount = get_min_amounts(auto_activate, xquery_bool, archive_mode_bool, amounts)
+                tier = get_tier(auto_activate, xquery_bool, archive_mode_bool)
+                min_amount = quotes.min_amounts[tier]
 
                 # set pending = True so next payment receives full credit as long as quote is valid
                 payment.pending = True
@@ -275,8 +320,12 @@ def create_or_extend_project(project_id=None):
                 payment.min_amount_aablock = min_amount['aablock']
                 payment.min_amount_sys = min_amount['sys']
                 payment.min_amount_sysblock = min_amount['sysblock']
+                for coin in coin_decimals:
+                    setattr(payment, f'min_amount_{coin}_raw', to_raw(min_amount[coin], coin))
 
                 commit()
+                quote_expiry.schedule(payment.id, payment.quote_start_time)
+                fields = get_project_fields(project, payment)
         except Exception as e:
             logging.critical('Exception while extending Project or Payment', exc_info=True)
             context = {
@@ -284,49 +333,17 @@ def create_or_extend_project(project_id=None):
             }
             return Response(response=json.dumps(context))
 
-    try:
-        with db_session:
-            project = Project.get(name=project_id)
-            payment = Payment.get(project=project_id)
-            if not project or not payment:
-                logging.critical('No Project or no Payment record retreived from db', exc_info=True)
-                context = {
-                    'error': 'No Project or no Payment record retreived from db'
-                }
-                return Response(response=json.dumps(context))
+    logging.info('Successfully created or extended project {}'.format(project_id))
 
-            context = {
-                'result': {
-                    'project_id': project.name,
-                    'api_key': project.api_key,
-                    'min_amount_eth': payment.min_amount_eth,
-                    'min_amount_ablock': payment.min_amount_ablock,
-                    'min_amount_avax': payment.min_amount_avax,
-                    'min_amount_aablock': payment.min_amount_aablock,
-                    'min_amount_sys': payment.min_amount_sys,
-                    'min_amount_sysblock': payment.min_amount_sysblock,
-                    'min_amount_usd': payment.min_amount_usd,
-                    'min_amount_ablock_usd': payment.min_amount_ablock_usd,
-                    'min_amount_aablock_usd': payment.min_amount_aablock_usd,
-                    'min_amount_sysblock_usd': payment.min_amount_sysblock_usd,
-                    'payment_eth_address': payment.eth_address,
-                    'payment_avax_address': payment.avax_address,
-                    'payment_nevm_address': payment.nevm_address,
-                    'quote_start_time': payment.quote_start_time.strftime("%Y-%m-%d %H:%M:%S UTC"),
-                    'quote_expiry_time': (payment.quote_start_time + datetime.timedelta(hours=quote_valid_hours)).strftime("%Y-%m-%d %H:%M:%S UTC")
-                }
-            }
+    return Response(response=quotes.response(tier, fields))
 
-        logging.info('Successfully created or extended project {}'.format(project_id))
-
-        return Response(response=json.dumps(context))
+@app.route("/quote", methods=['GET'])
+def quote_handler():
+    return Response(response=quote_cache.table().body)
 
-    except Exception as e:
-        logging.critical('Exception while generating response for newly created or extended Project or Payment', exc_info=True)
-        context = {
-            'error': 'Exception while generating response for newly created or extended Project or Payment'
-        }
-        return Response(response=json.dumps(context))
+@app.route("/metrics", methods=['GET'])
+def metrics_handler():
+    return Response(response=metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 #@app.route("/list_projects", methods=['GET'])
 #def list_projects():
@@ -354,14 +371,10 @@ def create_or_extend_project(project_id=None):
 
 @app.route("/<project_id>/api_count", methods=['POST'])
 def api_count_handler(project_id):
-    global api_count_cache
     if project_id:
-        if project_id in api_count_cache:
-            api_count_cache[project_id] += 1
-        else:
-            api_count_cache[project_id] = 1
+        count = api_counter.increment(project_id)
         context = {
-            'result': 'updated count {}'.format(api_count_cache[project_id]),
+            'result': 'updated count {}'.format(count),
             'error': 0
         }
     else:
@@ -0,0 +1,106 @@
+import threading
+import unittest
+import uuid
+
+from database.models import db_session, Project
+from util.api_counter import ApiCounter
+
+
+class ApiCounterTests(unittest.TestCase):
+    threads = 16
+    calls_per_thread = 20000
+
+    def setUp(self):
+        self.projects = [f'test-{uuid.uuid4()}' for _ in range(4)]
+        with db_session:
+            for name in self.projects:
+                Project(name=name, api_key='test', api_token_count=10**12, used_api_tokens=0, active=True, xquery=True, hydra=False)
+
+    def tearDown(self):
+        with db_session:
+            for name in self.projects:
+                project = Project.get(name=name)
+                if project:
+                    project.delete()
+
+    def test_no_counts_lost_under_concurrent_flushes(self):
+        counter = ApiCounter()
+        done = threading.Event()
+
+        def count(i):
+            for n in range(self.calls_per_thread):
+                counter.increment(self.projects[(i + n) % len(self.projects)])
+
+        def flush():
+            while not done.is_set():
+                counter.flush()
+            counter.flush()
+
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        workers = [threading.Thread(target=count, args=[i]) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        done.set()
+        flusher.join()
+
+        with db_session:
+            used = sum(Project[name].used_api_tokens for name in self.projects)
+        self.assertEqual(used, self.threads * self.calls_per_thread)
+
+    def test_increment_returns_count_since_flush(self):
+        counter = ApiCounter()
+        self.assertEqual([counter.increment(self.projects[0]) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(counter.increment(self.projects[1]), 1)
+        counter.flush()
+        self.assertEqual(counter.increment(self.projects[0]), 1)
+
+    def test_workers_share_postgres_backend(self):
+        # one ApiCounter per simulated worker process, each with its own flush thread
+        workers = [ApiCounter(backend='postgres') for _ in range(4)]
+        done = threading.Event()
+
+        def count(counter):
+            for n in range(self.calls_per_thread):
+                counter.increment(self.projects[n % len(self.projects)])
+
+        def flush(counter):
+            while not done.is_set():
+                counter.flush()
+            counter.flush()
+
+        flushers = [threading.Thread(target=flush, args=[counter]) for counter in workers]
+        counters = [threading.Thread(target=count, args=[counter]) for counter in workers for _ in range(2)]
+        for thread in flushers + counters:
+            thread.start()
+        for thread in counters:
+            thread.join()
+        done.set()
+        for thread in flushers:
+            thread.join()
+        workers[0].flush() # roll up whatever the last flushes appended while another worker held the rollup lock
+
+        with db_session:
+            used = sum(Project[name].used_api_tokens for name in self.projects)
+        self.assertEqual(used, len(counters) * self.calls_per_thread)
+
+    def test_flush_deactivates_exhausted_projects(self):
+        counter = ApiCounter()
+        with db_session:
+            Project[self.projects[0]].api_token_count = 5
+        for _ in range(5):
+            counter.increment(self.projects[0])
+        counter.increment(self.projects[1])
+        counter.increment('unknown-project')
+        counter.flush()
+        with db_session:
+            self.assertEqual(Project[self.projects[0]].used_api_tokens, 5)
+            self.assertFalse(Project[self.projects[0]].active)
+            self.assertEqual(Project[self.projects[1]].used_api_tokens, 1)
+            self.assertTrue(Project[self.projects[1]].active)
+
+
+if __name__ == '__main__':
+    unittest.main()
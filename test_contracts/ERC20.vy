@@ -0,0 +1,31 @@
+# @version 0.3.10
+# Minimal ERC20 standing in for aBLOCK/aaBLOCK/sysBLOCK in the tests.
+
+event Transfer:
+    sender: indexed(address)
+    receiver: indexed(address)
+    value: uint256
+
+name: public(String[32])
+symbol: public(String[32])
+decimals: public(uint8)
+totalSupply: public(uint256)
+balanceOf: public(HashMap[address, uint256])
+
+
+@external
+def __init__(_symbol: String[32], _decimals: uint8, _supply: uint256):
+    self.name = _symbol
+    self.symbol = _symbol
+    self.decimals = _decimals
+    self.totalSupply = _supply
+    self.balanceOf[msg.sender] = _supply
+    log Transfer(empty(address), msg.sender, _supply)
+
+
+@external
+def transfer(_to: address, _value: uint256) -> bool:
+    self.balanceOf[msg.sender] -= _value
+    self.balanceOf[_to] += _value
+    log Transfer(msg.sender, _to, _value)
+    return True
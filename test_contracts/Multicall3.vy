@@ -0,0 +1,36 @@
+# @version 0.3.10
+# Minimal stand-in for Multicall3 (https://github.com/mds1/multicall) used by the
+# tests; exposes the same aggregate3/getEthBalance/getBlockNumber ABI.
+
+struct Call3:
+    target: address
+    allowFailure: bool
+    callData: Bytes[256]
+
+struct Result:
+    success: bool
+    returnData: Bytes[256]
+
+
+@external
+def aggregate3(calls: DynArray[Call3, 1024]) -> DynArray[Result, 1024]:
+    results: DynArray[Result, 1024] = []
+    for call in calls:
+        success: bool = False
+        data: Bytes[256] = b""
+        success, data = raw_call(call.target, call.callData, max_outsize=256, revert_on_failure=False)
+        assert success or call.allowFailure, "Multicall3: call failed"
+        results.append(Result({success: success, returnData: data}))
+    return results
+
+
+@external
+@view
+def getEthBalance(addr: address) -> uint256:
+    return addr.balance
+
+
+@external
+@view
+def getBlockNumber() -> uint256:
+    return block.number
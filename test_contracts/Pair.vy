@@ -0,0 +1,33 @@
+# @version 0.3.10
+# Minimal uniswap v2 style pair used by the price reader tests; reserves are set
+# directly with sync() instead of through swaps.
+
+event Sync:
+    reserve0: uint112
+    reserve1: uint112
+
+token0: public(address)
+token1: public(address)
+reserve0: uint112
+reserve1: uint112
+blockTimestampLast: uint32
+
+
+@external
+def __init__(_token0: address, _token1: address):
+    self.token0 = _token0
+    self.token1 = _token1
+
+
+@external
+@view
+def getReserves() -> (uint112, uint112, uint32):
+    return self.reserve0, self.reserve1, self.blockTimestampLast
+
+
+@external
+def sync(_reserve0: uint112, _reserve1: uint112):
+    self.reserve0 = _reserve0
+    self.reserve1 = _reserve1
+    self.blockTimestampLast = convert(block.timestamp % 2**32, uint32)
+    log Sync(_reserve0, _reserve1)
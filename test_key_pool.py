@@ -0,0 +1,55 @@
+import threading
+import unittest
+
+from eth_account import Account
+from database.models import db, db_session
+from util.key_pool import KeyPool
+
+
+class KeyPoolTests(unittest.TestCase):
+    def setUp(self):
+        with db_session:
+            if db.select('SELECT count(*) FROM depositkey')[0]:
+                self.skipTest('depositkey table is not empty')
+        self.pool = KeyPool(secret='test secret', low=50, high=200)
+
+    def tearDown(self):
+        with db_session:
+            db.execute('DELETE FROM depositkey')
+
+    def test_fill_and_claim(self):
+        self.pool.fill()
+        self.assertEqual(self.pool.size(), 200)
+        with db_session:
+            stored = db.select('SELECT privkey FROM depositkey LIMIT 1')[0]
+        self.assertEqual(len(bytes.fromhex(stored)), 16 + 16 + 32) # nonce, tag, encrypted key
+
+        keys = self.pool.get_keys(3)
+        for address, privkey in keys:
+            self.assertEqual(Account.from_key(privkey).address, address)
+        self.assertEqual(self.pool.size(), 197)
+
+        self.pool.claim(150)
+        self.pool.fill() # below the low watermark, refilled to the high one
+        self.assertEqual(self.pool.size(), 200)
+
+    def test_concurrent_claims_get_distinct_keys(self):
+        self.pool.fill()
+        claimed = []
+
+        def claim():
+            for _ in range(25):
+                claimed.extend(self.pool.get_keys(3))
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), 300) # more than the pool held, the rest generated on the spot
+        self.assertEqual(len({address for address, privkey in claimed}), 300)
+        self.assertEqual(self.pool.size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
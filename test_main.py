@@ -1,6 +1,39 @@
+import json
+import os
+import tempfile
+import time
+import threading
 import unittest
 
+from web3 import Web3, EthereumTesterProvider
 from util import get_eth_amount, min_payment_amount_tier1, min_payment_amount_tier2
+from util.multicall import aggregate_balances, multicall_abi
+from util.deposit_scanner import get_transfer_addresses, get_native_addresses
+from util.poll_tiers import PollTiers, warm_interval, cold_interval, hot_window
+from util.price_oracle import PriceOracle, PriceSnapshot, price_max_staleness
+from util.quote_table import QuoteTable
+from util.head_watcher import HeadWatcher
+from util.pool_reader import PoolReader, RouterPairs, get_amount_out
+from util.providers import metrics_middleware
+from util import metrics
+from util.balance_snapshot import BalanceSnapshot
+from util.units import to_raw, to_amount
+from util import rpc_budget
+from util.rpc_budget import TokenBucket, Coalescer
+
+# same as util.eth_payments.coin_names, which can't be imported without a database
+coin_names = {'eth': {True: 'eth', False: 'ablock'}, 'avax': {True: 'avax', False: 'aablock'}, 'nevm': {True: 'sys', False: 'sysblock'}}
+
+# abi/bytecode of the contracts in test_contracts/, compiled with `vyper --evm-version london`
+with open('test_contracts/compiled.json', 'r') as file:
+    compiled_contracts = json.load(file)
+
+
+def deploy_contract(w3, name, *args):
+    factory = w3.eth.contract(abi=compiled_contracts[name]['abi'], bytecode=compiled_contracts[name]['bytecode'])
+    tx_hash = factory.constructor(*args).transact({'from': w3.eth.accounts[0]})
+    receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
+    return w3.eth.contract(address=receipt.contractAddress, abi=compiled_contracts[name]['abi'])
 
 
 class MainTests(unittest.TestCase):
@@ -15,5 +48,402 @@ class MainTests(unittest.TestCase):
         self.assertGreater(result, 0, 'expecting tier2 eth amount to be > 0')
 
 
+class MulticallTests(unittest.TestCase):
+    def setUp(self):
+        self.w3 = Web3(EthereumTesterProvider())
+        deployed = deploy_contract(self.w3, 'Multicall3')
+        self.multicall = self.w3.eth.contract(address=deployed.address, abi=multicall_abi)
+        self.token = deploy_contract(self.w3, 'ERC20', 'aBLOCK', 8, 10**16)
+        self.owner = self.w3.eth.accounts[0]
+        self.addresses = [self.w3.eth.account.create().address for _ in range(25)]
+
+    def fund(self, address, wei, tokens):
+        if wei:
+            self.w3.eth.send_transaction({'from': self.owner, 'to': address, 'value': wei})
+        if tokens:
+            self.token.functions.transfer(address, tokens).transact({'from': self.owner})
+
+    def test_aggregate_balances_match_per_address_reads(self):
+        for i, address in enumerate(self.addresses):
+            self.fund(address, i * 10**15, (i % 3) * 10**8)
+        block_number, native, balances = aggregate_balances(self.multicall, self.token, self.addresses, chunk_size=7)
+        self.assertEqual(block_number, self.w3.eth.block_number)
+        for address in self.addresses:
+            self.assertEqual(native[address], self.w3.eth.get_balance(address))
+            self.assertEqual(balances[address], self.token.functions.balanceOf(address).call())
+
+    def test_aggregate_balances_pinned_to_block(self):
+        address = self.addresses[0]
+        self.fund(address, 10**18, 5 * 10**8)
+        pinned_block = self.w3.eth.block_number
+        self.fund(address, 10**18, 5 * 10**8)
+        block_number, native, balances = aggregate_balances(self.multicall, self.token, [address], block_identifier=pinned_block)
+        self.assertEqual(block_number, pinned_block)
+        self.assertEqual(native[address], 10**18)
+        self.assertEqual(balances[address], 5 * 10**8)
+
+
+class DepositScannerTests(unittest.TestCase):
+    def setUp(self):
+        self.w3 = Web3(EthereumTesterProvider())
+        self.token = deploy_contract(self.w3, 'ERC20', 'aBLOCK', 8, 10**16)
+        self.owner = self.w3.eth.accounts[0]
+        self.addresses = [self.w3.eth.account.create().address for _ in range(5)]
+        self.deposit_addresses = {address.lower(): address.lower() for address in self.addresses[:3]}
+
+    def test_get_transfer_addresses(self):
+        start_block = self.w3.eth.block_number + 1
+        for address in self.addresses[1:]:
+            self.token.functions.transfer(address, 10**8).transact({'from': self.owner})
+        hits = get_transfer_addresses(self.w3, self.token.address, start_block, self.w3.eth.block_number,
+                                      self.deposit_addresses, batch_blocks=2)
+        self.assertEqual(hits, {self.addresses[1].lower(), self.addresses[2].lower()})
+        hits = get_transfer_addresses(self.w3, self.token.address, self.w3.eth.block_number + 1, self.w3.eth.block_number,
+                                      self.deposit_addresses)
+        self.assertEqual(hits, set())
+
+    def test_get_native_addresses(self):
+        start_block = self.w3.eth.block_number + 1
+        for address in self.addresses[2:]:
+            self.w3.eth.send_transaction({'from': self.owner, 'to': address, 'value': 10**18})
+        self.token.functions.transfer(self.addresses[0], 10**8).transact({'from': self.owner})
+        sweeper = self.w3.eth.accounts[1]
+        self.deposit_addresses[sweeper.lower()] = sweeper.lower() # a deposit address swept by its owner
+        self.w3.eth.send_transaction({'from': sweeper, 'to': self.owner, 'value': 10**18})
+        hits = get_native_addresses(self.w3, start_block, self.w3.eth.block_number, self.deposit_addresses, batch_blocks=3)
+        self.assertEqual(hits, {self.addresses[2].lower(), sweeper.lower()})
+
+
+class PollTiersTests(unittest.TestCase):
+    def test_tiers_and_due(self):
+        now = 10**9
+        tiers = PollTiers()
+        tiers.update([('pending', True, True, now), ('active', False, True, now - 10**8), ('dormant', False, False, now - 10**8)])
+        self.assertEqual(set(tiers.due(now)), {'pending', 'active', 'dormant'}) # never polled
+        tiers.mark_polled(['pending', 'active', 'dormant'], now)
+        self.assertEqual(tiers.counts(now), {'hot': 1, 'warm': 1, 'cold': 1})
+        self.assertEqual(tiers.due(now + 1), ['pending'])
+        self.assertEqual(set(tiers.due(now + warm_interval)), {'pending', 'active'})
+        self.assertEqual(set(tiers.due(now + cold_interval)), {'pending', 'active', 'dormant'})
+
+    def test_balance_change_moves_address_to_hot_tier(self):
+        now = 10**9
+        tiers = PollTiers()
+        tiers.update([('dormant', False, False, now - 10**8)])
+        tiers.observe('dormant', True, 0, now)
+        tiers.mark_polled(['dormant'], now)
+        self.assertEqual(tiers.counts(now)['cold'], 1)
+        tiers.observe('dormant', True, 1.5, now)
+        self.assertEqual(tiers.due(now + 1), ['dormant'])
+        self.assertEqual(tiers.counts(now + hot_window)['warm'], 1)
+
+    def test_resume_from_checkpoint(self):
+        now = 10**9
+        tiers = PollTiers()
+        tiers.update([('pending', True, True, now), ('active', False, True, now - 10**8), ('dormant', False, False, now - 10**8)])
+        tiers.resume(now - warm_interval) # restarted, last processed block was warm_interval ago
+        self.assertEqual(set(tiers.due(now)), {'pending', 'active'})
+
+
+class PoolReaderTests(unittest.TestCase):
+    def setUp(self):
+        self.w3 = Web3(EthereumTesterProvider())
+        self.calls = []
+        self.w3.middleware_onion.add(self.record_calls)
+        wsys = deploy_contract(self.w3, 'ERC20', 'WSYS', 18, 10**30)
+        usdt = deploy_contract(self.w3, 'ERC20', 'USDT', 6, 10**30)
+        sysblock = deploy_contract(self.w3, 'ERC20', 'sysBLOCK', 8, 10**30)
+        self.pools = {'usdt': deploy_contract(self.w3, 'Pair', wsys.address, usdt.address).address,
+                      'sysblock': deploy_contract(self.w3, 'Pair', sysblock.address, wsys.address).address}
+        owner = {'from': self.w3.eth.accounts[0]}
+        self.w3.eth.contract(address=self.pools['usdt'], abi=compiled_contracts['Pair']['abi']).functions.sync(1000 * 10**18, 200 * 10**6).transact(owner)
+        self.w3.eth.contract(address=self.pools['sysblock'], abi=compiled_contracts['Pair']['abi']).functions.sync(50 * 10**8, 1000 * 10**18).transact(owner)
+        self.metadata_file = os.path.join(tempfile.mkdtemp(), 'pool_metadata.json')
+
+    def record_calls(self, make_request, w3):
+        def middleware(method, params):
+            if method == 'eth_call':
+                self.calls.append(params[0]['to'])
+            return make_request(method, params)
+        return middleware
+
+    def test_metadata_is_read_once_and_persisted(self):
+        reader = PoolReader(self.w3, self.pools, metadata_file=self.metadata_file)
+        self.assertEqual(reader.get_prices('WSYS'), {'usdt': 0.2, 'sysblock': 0.05})
+        self.calls.clear()
+        reader.get_prices('WSYS')
+        self.assertEqual(sorted(self.calls), sorted(self.pools.values())) # one getReserves per pool
+
+        self.calls.clear()
+        restarted = PoolReader(self.w3, self.pools, metadata_file=self.metadata_file)
+        self.assertEqual(restarted.get_prices('WSYS'), {'usdt': 0.2, 'sysblock': 0.05})
+        self.assertEqual(sorted(self.calls), sorted(self.pools.values()))
+
+    def test_tracked_reserves_follow_sync_events(self):
+        reader = PoolReader(self.w3, self.pools, metadata_file=self.metadata_file, track_reserves=True)
+        reader.tracker.window = 100
+        self.assertEqual(reader.get_prices('WSYS'), {'usdt': 0.2, 'sysblock': 0.05})
+        start = self.w3.eth.get_block('latest')['timestamp']
+        self.calls.clear()
+        self.assertEqual(reader.get_prices('WSYS'), {'usdt': 0.2, 'sysblock': 0.05})
+        self.assertEqual(self.calls, []) # no new block, nothing read
+
+        tester = self.w3.provider.ethereum_tester
+        tester.time_travel(start + 40)
+        pair = self.w3.eth.contract(address=self.pools['usdt'], abi=compiled_contracts['Pair']['abi'])
+        pair.functions.sync(1000 * 10**18, 400 * 10**6).transact({'from': self.w3.eth.accounts[0]})
+        synced = self.w3.eth.get_block('latest')['timestamp']
+        tester.time_travel(start + 100)
+        end = self.w3.eth.get_block('latest')['timestamp']
+        prices = reader.get_prices('WSYS')
+        self.assertEqual(self.calls, []) # reserves come from the Sync log, not getReserves
+        self.assertEqual(reader.tracker.reserves['usdt'], (1000 * 10**18, 400 * 10**6))
+        self.assertAlmostEqual(prices['usdt'], (0.2 * (synced - start) + 0.4 * (end - synced)) / (end - start))
+        self.assertEqual(prices['sysblock'], 0.05)
+
+        reader.tracker.window = 0
+        self.assertEqual(reader.get_prices('WSYS'), {'usdt': 0.4, 'sysblock': 0.05})
+
+    def test_router_pairs_quote_from_tracked_reserves(self):
+        weth = deploy_contract(self.w3, 'ERC20', 'WETH', 18, 10**30).address
+        usdt = deploy_contract(self.w3, 'ERC20', 'USDT', 6, 10**30).address
+        pair = self.w3.eth.contract(address=deploy_contract(self.w3, 'Pair', usdt, weth).address, abi=compiled_contracts['Pair']['abi'])
+        owner = {'from': self.w3.eth.accounts[0]}
+        pair.functions.sync(2 * 10**6 * 10**6, 1000 * 10**18).transact(owner) # 2000 usdt per weth
+        pairs = RouterPairs(self.w3, None, [(weth, usdt)])
+        # as resolved by load_reader from the router's factory
+        pairs.reader = PoolReader(self.w3, {f'{weth}/{usdt}': pair.address}, metadata_file=self.metadata_file, track_reserves=True)
+        self.assertEqual(pairs.get_amount_out(weth, usdt, 10**18), get_amount_out(10**18, 1000 * 10**18, 2 * 10**12))
+        self.assertEqual(get_amount_out(10**18, 1000 * 10**18, 2 * 10**12), 1992013962) # 2000 usdt less the fee and price impact
+        pair.functions.sync(4 * 10**6 * 10**6, 1000 * 10**18).transact(owner)
+        self.calls.clear()
+        self.assertEqual(pairs.get_amount_out(weth, usdt, 10**18), get_amount_out(10**18, 1000 * 10**18, 4 * 10**12))
+        self.assertEqual(self.calls, []) # from the Sync log, no getAmountsOut or getReserves
+
+
+class PriceOracleTests(unittest.TestCase):
+    def test_refresh_is_parallel_and_keeps_last_price_of_failed_sources(self):
+        release = threading.Event()
+        calls = {'flaky': 0}
+
+        def flaky():
+            calls['flaky'] += 1
+            if calls['flaky'] > 1:
+                raise ValueError('node down')
+            return 4.0
+
+        def hanging():
+            release.wait()
+            return 3.0
+
+        oracle = PriceOracle({'slow1': lambda: time.sleep(0.3) or 1.0, 'slow2': lambda: time.sleep(0.3) or 2.0,
+                              'hanging': hanging, 'flaky': flaky}, timeout=1)
+        start = time.time()
+        first = oracle.snapshot()
+        self.assertLess(time.time() - start, 1.5) # sources ran in parallel, the hanging one was cut off at the timeout
+        self.assertEqual(first.price('slow1'), 1.0)
+        self.assertEqual(first.price('slow2'), 2.0)
+        self.assertIsNone(first.price('hanging'))
+        self.assertEqual(first.amount('flaky', 2), 0.5)
+
+        second = oracle.refresh()
+        self.assertEqual(second.price('flaky'), 4.0)
+        self.assertEqual(second.times['flaky'], first.times['flaky'])
+        self.assertIsNone(second.price('hanging')) # still busy, not queried again
+        release.set()
+
+    def test_stale_prices_are_not_quoted(self):
+        oracle = PriceOracle({'eth': lambda: 2000.0})
+        snapshot = oracle.snapshot()
+        fetched = snapshot.times['eth']
+        self.assertEqual(snapshot.amount('eth', 100, max_staleness=60, now=fetched + 60), 0.05)
+        self.assertIsNone(snapshot.amount('eth', 100, max_staleness=60, now=fetched + 61))
+        self.assertAlmostEqual(snapshot.age('eth', now=fetched + 30), 30)
+        with self.assertRaises(AttributeError):
+            snapshot.prices = {}
+
+    def test_followers_load_the_published_snapshot(self):
+        published = []
+        leader = PriceOracle({'eth': lambda: 2000.0})
+        leader.publish = published.append
+        queried = []
+        follower = PriceOracle({'eth': lambda: queried.append('eth') or 1.0})
+        follower.follow = lambda: published[-1]
+        snapshot = leader.snapshot()
+        self.assertIs(follower.snapshot(), snapshot)
+        self.assertEqual(queried, [])
+        follower.follow = None # became leader
+        follower.sources = {'eth': lambda: 2100.0}
+        self.assertEqual(follower.refresh().price('eth'), 2100.0)
+
+
+class QuoteTableTests(unittest.TestCase):
+    def test_table_matches_snapshot(self):
+        now = 10**9
+        snapshot = PriceSnapshot({'eth': 2000.0, 'ablock': 0.5}, {'eth': now - 10, 'ablock': now - 20})
+        table = QuoteTable(snapshot, coin_names, {'eth': 'node', 'avax': 'node', 'nevm': ''}, now)
+        self.assertTrue(table.available())
+        self.assertEqual(table.min_amounts['tier1']['eth'], snapshot.amount('eth', min_payment_amount_tier1, now=now))
+        self.assertIsNone(table.min_amounts['tier1']['avax']) # no price
+        self.assertIsNone(table.amounts['tier1_min_amount_sys']) # chain not configured
+        self.assertEqual(table.min_amounts['free']['ablock'], 0)
+        self.assertEqual(table.valid_until, now - 20 + price_max_staleness)
+
+        response = json.loads(table.response('tier2', {'project_id': 'p'}))['result']
+        self.assertEqual(response['project_id'], 'p')
+        self.assertEqual(response['min_amount_eth'], table.min_amounts['tier2']['eth'])
+        self.assertEqual(response['min_amount_ablock_usd'], table.min_amounts['tier2']['ablock_usd'])
+
+
+class HeadWatcherTests(unittest.TestCase):
+    def test_polls_until_head_advances(self):
+        w3 = Web3(EthereumTesterProvider())
+        heads = HeadWatcher(w3, 'eth-tester', 'http')
+        self.assertEqual(heads.wait_for_new_head(1), w3.eth.block_number)
+        self.assertIsNone(heads.wait_for_new_head(0.5)) # no new block
+
+        timer = threading.Timer(0.5, lambda: w3.provider.ethereum_tester.mine_blocks(2))
+        timer.start()
+        start = time.time()
+        self.assertEqual(heads.wait_for_new_head(10), w3.eth.block_number)
+        self.assertLess(time.time() - start, 5)
+        timer.join()
+
+
+class BalanceSnapshotTests(unittest.TestCase):
+    def test_only_moved_balances_are_changes(self):
+        snapshot = BalanceSnapshot()
+        polled = {True: {'0xA': 0, '0xB': 5}, False: {'0xA': 7}}
+        changes = snapshot.changes(polled)
+        self.assertEqual(sorted(changes), [('0xA', False, 7), ('0xA', True, 0), ('0xB', True, 5)]) # never seen
+        self.assertEqual(snapshot.changes(polled), changes) # not recorded until handled
+        snapshot.update(changes)
+        self.assertEqual(snapshot.changes(polled), [])
+
+        self.assertEqual(snapshot.changes({True: {'0xa': 0, '0xB': 6}, False: {}}), [('0xB', True, 6)])
+        snapshot.forget(['0xa'])
+        self.assertEqual(snapshot.changes({True: {'0xA': 0}, False: {'0xA': 7}}), [('0xA', True, 0), ('0xA', False, 7)])
+
+
+class UnitsTests(unittest.TestCase):
+    def test_raw_amounts_are_exact(self):
+        self.assertEqual(to_raw(0.1, 'eth'), 10**17)
+        self.assertEqual(to_raw(1.23456789, 'ablock'), 123456789)
+        self.assertEqual(to_raw(123.4567890123, 'avax'), 123456789012300000000)
+        self.assertIsNone(to_raw(None, 'sys'))
+        self.assertEqual(to_amount(123456789, 'aablock'), 1.23456789)
+        # three 0.1 eth payments add up to the 0.3 eth quoted, which floats miss
+        self.assertNotEqual(0.1 + 0.1 + 0.1, 0.3)
+        self.assertEqual(3*to_raw(0.1, 'eth'), to_raw(0.3, 'eth'))
+
+
+class RpcBudgetTests(unittest.TestCase):
+    def test_deposits_are_served_before_prices(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.acquire(1, 'deposits') # empty the bucket
+        served = []
+
+        def call(priority):
+            bucket.acquire(1, priority)
+            served.append(priority)
+
+        threads = [threading.Thread(target=call, args=[priority]) for priority in ['prices', 'prices', 'api', 'deposits']]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(served, ['deposits', 'api', 'prices', 'prices'])
+
+    def test_identical_calls_in_flight_are_sent_once(self):
+        coalescer = Coalescer()
+        sent = []
+
+        def make_request(method, params):
+            sent.append(params)
+            time.sleep(0.2)
+            return {'result': params[0]}
+
+        results = []
+        threads = [threading.Thread(target=lambda params: results.append(coalescer.request('eth_call', params, make_request)), args=[params])
+                   for params in [['0x1', 10], ['0x1', 10], ['0x1', 10], ['0x2', 10]]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(sent), [['0x1', 10], ['0x2', 10]])
+        self.assertEqual(sorted(result['result'] for result in results), ['0x1', '0x1', '0x1', '0x2'])
+        coalescer.request('eth_call', ['0x1', 10], make_request) # not in flight anymore
+        self.assertEqual(len(sent), 3)
+
+    def test_share_splits_the_rate(self):
+        os.environ['TEST_RPC_RATE'] = '50'
+        self.addCleanup(os.environ.pop, 'TEST_RPC_RATE')
+        self.addCleanup(rpc_budget.budgets.pop, 'test', None)
+        self.addCleanup(rpc_budget.shares.pop, 'test', None)
+        self.assertEqual(rpc_budget.get_budget('test').rate, 50)
+        rpc_budget.set_share('test', 0.2)
+        self.assertEqual(rpc_budget.get_budget('test').rate, 10)
+        self.assertEqual(rpc_budget.get_budget('test').burst, 10)
+
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram_render(self):
+        histogram = metrics.Histogram('test_seconds', 'Test latency', ['chain'], buckets=(0.1, 1))
+        self.addCleanup(metrics.registry.remove, histogram)
+        histogram.observe(0.05, 'eth')
+        histogram.observe(0.5, 'eth')
+        histogram.observe(5, 'eth')
+        with histogram.time('avax'):
+            pass
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{chain="eth",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{chain="eth",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{chain="eth",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{chain="eth"} 5.55', lines)
+        self.assertIn('test_seconds_count{chain="eth"} 3', lines)
+        self.assertIn('test_seconds_count{chain="avax"} 1', lines)
+
+    def test_rpc_middleware(self):
+        w3 = Web3(EthereumTesterProvider())
+        w3.middleware_onion.inject(metrics_middleware('test'), name='metrics', layer=0)
+        w3.eth.block_number
+        w3.eth.block_number
+        self.assertEqual(metrics.rpc_calls_total.values[('test', 'eth_blockNumber')], 2)
+        self.assertEqual(metrics.rpc_request_seconds.values[('test', 'eth_blockNumber')][2], 2)
+
+    def test_multiprocess_render(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        metrics_dir = metrics.metrics_dir
+        metrics.metrics_dir = directory.name
+        self.addCleanup(setattr, metrics, 'metrics_dir', metrics_dir)
+        counter = metrics.Counter('test_total', 'Test calls', ['chain'])
+        histogram = metrics.Histogram('test_seconds', 'Test latency', ['chain'], buckets=(0.1, 1))
+        gauge = metrics.Gauge('test_age_seconds', 'Test age', lambda: {(): 3})
+        for metric in (counter, histogram, gauge):
+            self.addCleanup(metrics.registry.remove, metric)
+        counter.inc('eth', amount=2)
+        histogram.observe(0.5, 'eth')
+        # another worker, and a worker that stopped writing long ago
+        for pid, written in ((1, time.time()), (2, time.time() - 3600)):
+            with open(os.path.join(directory.name, f'{pid}.json'), 'w') as file:
+                json.dump({'pid': pid, 'time': written, 'exiting': False, 'metrics': [
+                    {'name': 'test_total', 'help': 'Test calls', 'type': 'counter', 'labels': ['chain'], 'values': [[['eth'], 3]]},
+                    {'name': 'test_seconds', 'help': 'Test latency', 'type': 'histogram', 'labels': ['chain'],
+                     'buckets': [0.1, 1], 'values': [[['eth'], [1, 0, 0], 0.05, 1]]},
+                    {'name': 'test_age_seconds', 'help': 'Test age', 'type': 'gauge', 'labels': [], 'values': [[[], 7]]}]}, file)
+        lines = metrics.render().splitlines()
+        self.assertEqual(lines.count('# TYPE test_total counter'), 1)
+        self.assertIn('test_total{chain="eth"} 8', lines)
+        self.assertIn('test_seconds_bucket{chain="eth",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{chain="eth",le="1"} 3', lines)
+        self.assertIn('test_seconds_count{chain="eth"} 3', lines)
+        self.assertIn(f'test_age_seconds{{pid="{os.getpid()}"}} 3', lines)
+        self.assertIn('test_age_seconds{pid="1"} 7', lines)
+        self.assertNotIn('test_age_seconds{pid="2"} 7', lines)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,353 @@
+import datetime
+import json
+import threading
+import time
+import unittest
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from web3 import Web3, EthereumTesterProvider
+from database.models import db_session, Project, Payment, ChainCursor, CoinPrice
+from util import min_api_calls, quote_valid_hours
+from util import metrics, chain_workers, eth_payments, leader, rpc_batch
+from util.rpc_batch import batch_request, BatchRequestError
+from util.multicall import multicall_abi
+from util.address_registry import AddressRegistry, RegistryEntry
+from util.eth_payments import Web3Helper, Cursor
+from util.price_oracle import PriceSnapshot
+from util.shared_prices import save_prices, load_prices
+from test_main import deploy_contract
+
+
+test_project_prefix = 'unittest-' # projects created by the tests, deleted after each test
+
+
+# returns the id of a new payment of a new test project
+@db_session
+def create_payment(name, **columns):
+    project = Project(name=test_project_prefix + name, api_key='key', api_token_count=0, used_api_tokens=0, active=False, xquery=True, hydra=False)
+    columns.setdefault('quote_start_time', datetime.datetime.now())
+    payment = Payment(project=project, **columns)
+    payment.flush()
+    return payment.id
+
+
+@db_session
+def delete_test_projects():
+    Payment.select(lambda p: p.project.name.startswith(test_project_prefix)).delete(bulk=True)
+    Project.select(lambda p: p.name.startswith(test_project_prefix)).delete(bulk=True)
+
+
+class AddressRegistryTests(unittest.TestCase):
+    def setUp(self):
+        delete_test_projects()
+        self.addCleanup(delete_test_projects)
+
+    def test_rows_committed_out_of_order_are_fetched(self):
+        registry = AddressRegistry('nevm', ['sys', 'sysblock'])
+        now = datetime.datetime.now()
+        create_payment('first', nevm_address='0xAAA', quote_start_time=now)
+        late = create_payment('late', nevm_address='0xBBB', quote_start_time=now - datetime.timedelta(seconds=30))
+        self.assertEqual(sorted(registry.refresh()), ['0xAAA', '0xBBB'])
+        # as if the late row committed only after a refresh which already saw a higher id and a newer quote
+        del registry.entries['0xbbb']
+        registry.max_id = late
+        self.assertEqual(registry.refresh(), ['0xBBB'])
+        self.assertEqual(registry.get('0xbbb').payment_id, late)
+        self.assertEqual(registry.refresh(), []) # fetched again by the overlap, but unchanged
+
+
+@db_session
+def delete_test_prices():
+    CoinPrice.select(lambda c: c.coin.startswith('unittest-')).delete(bulk=True)
+
+
+@db_session
+def delete_cursors(evm):
+    ChainCursor.select(lambda c: c.name in [evm, f'{evm}_transfer_logs', f'{evm}_blocks']).delete(bulk=True)
+
+
+class CreditTests(unittest.TestCase):
+    """Runs the eth payment processing cycle against eth-tester, with aBLOCK
+    deposits to an eth-tester account, which can also send them back."""
+
+    def setUp(self):
+        delete_test_projects()
+        delete_cursors('eth')
+        self.addCleanup(delete_test_projects)
+        self.addCleanup(delete_cursors, 'eth')
+        self.w3 = Web3(EthereumTesterProvider())
+        self.token = deploy_contract(self.w3, 'ERC20', 'aBLOCK', 8, 10**16)
+        self.owner, self.address = self.w3.eth.accounts[:2]
+        self.addCleanup(eth_payments.confirmations.__setitem__, 'eth', eth_payments.confirmations['eth'])
+        self.addCleanup(eth_payments.block_contract_address.__setitem__, 'eth', eth_payments.block_contract_address['eth'])
+        eth_payments.confirmations['eth'] = 0
+        eth_payments.block_contract_address['eth'] = self.token.address
+        self.helper = Web3Helper()
+        self.helper.w3['eth'] = self.w3
+        self.helper.contract['eth'] = self.token
+        self.payment = create_payment('credit', eth_address=self.address, pending=True, min_amount_ablock=1.0,
+                                      min_amount_ablock_raw=Decimal(10**8), amount_ablock=0.0, amount_ablock_raw=Decimal(0))
+
+    def cycle(self):
+        self.helper.fetch_evm_accounts('eth')
+        self.helper.handle_evm_event('eth')
+
+    # returns (api_token_count, active, amount_ablock_raw) of the test payment
+    @db_session
+    def credited(self):
+        payment = Payment[self.payment]
+        return payment.project.api_token_count, payment.project.active, int(payment.amount_ablock_raw)
+
+    def deposit(self, raw):
+        self.token.functions.transfer(self.address, raw).transact({'from': self.owner})
+
+    def test_deposits_and_withdrawal(self):
+        self.cycle()
+        self.assertEqual(self.credited(), (0, False, 0))
+        self.deposit(5 * 10**7)
+        self.assertEqual(self.helper.get_credits('eth', [(self.address, False, 5 * 10**7)]), []) # underpaid
+        self.cycle()
+        self.assertEqual(self.credited(), (0, False, 0))
+        self.deposit(5 * 10**7) # adds up to the min amount
+        self.cycle()
+        self.assertEqual(self.credited(), (min_api_calls, True, 10**8))
+        self.deposit(25 * 10**7) # top-up
+        self.cycle()
+        self.assertEqual(self.credited(), (3 * min_api_calls + min_api_calls // 2, True, 35 * 10**7))
+        self.token.functions.transfer(self.owner, 3 * 10**8).transact({'from': self.address}) # withdrawal
+        self.cycle()
+        self.assertEqual(self.credited(), (3 * min_api_calls + min_api_calls // 2, True, 5 * 10**7))
+        self.assertEqual(self.helper.registry['eth'].get(self.address).amounts['ablock'], 5 * 10**7)
+        self.deposit(10**8) # a deposit after a withdrawal is credited from the lower amount
+        self.cycle()
+        self.assertEqual(self.credited()[0], 4 * min_api_calls + min_api_calls // 2)
+
+    def test_multicall_with_token_log_scan(self):
+        self.addCleanup(setattr, eth_payments, 'scan_token_logs', eth_payments.scan_token_logs)
+        eth_payments.scan_token_logs = True
+        self.helper.multicall['eth'] = self.w3.eth.contract(address=deploy_contract(self.w3, 'Multicall3').address, abi=multicall_abi)
+        per_address = []
+        self.helper.check_balance = lambda *args: per_address.append(args) or {}
+        self.deposit(10**8)
+        self.cycle() # the first scan returns every address, all of them due
+        self.assertEqual(self.credited(), (min_api_calls, True, 10**8))
+        self.assertEqual(per_address, [])
+
+    def test_failed_cycle_polls_again(self):
+        with db_session:
+            Payment[self.payment].pending = False # warm, so only polled again after warm_interval once marked polled
+        self.deposit(10**8)
+        self.addCleanup(setattr, leader, 'lock_pid', leader.lock_pid)
+        leader.lock_pid = 1 # not the pid holding the leader lock
+        self.helper.fetch_evm_accounts('eth')
+        with self.assertRaises(leader.LeaderLockLost):
+            self.helper.handle_evm_event('eth')
+        self.assertIn(self.address, self.helper.poll_tiers['eth'].due())
+        self.assertEqual(self.credited(), (0, False, 0))
+        leader.lock_pid = None
+        self.cycle()
+        self.assertEqual(self.credited(), (min_api_calls // 2, True, 10**8)) # half the tokens, the quote expired
+        self.assertNotIn(self.address, self.helper.poll_tiers['eth'].due())
+
+    # returns api_token_count and the (coin_name, value, active) updates after crediting value aBLOCK base units to a new payment with columns
+    def credit(self, value, **columns):
+        address = self.w3.eth.account.create().address
+        payment_id = create_payment(address[2:10], eth_address=address, **columns)
+        self.helper.load_cursors('eth')
+        updates = self.helper.credit_payments('eth', [(RegistryEntry(payment_id, address), 'ablock', value)])
+        with db_session:
+            return Payment[payment_id].project.api_token_count, [update[1:] for update in updates]
+
+    def test_credit_raw_row(self):
+        raw = dict(min_amount_ablock=0.3, min_amount_ablock_raw=Decimal(3 * 10**7 + 1), amount_ablock=0.1, amount_ablock_raw=Decimal(10**7))
+        # tokens are rounded down: 9 * 10**7 * 1000 // (3 * 10**7 + 1) = 2999
+        self.assertEqual(self.credit(10**8, pending=True, **raw), (2999, [('ablock', 10**8, True)]))
+        self.assertEqual(self.credit(10**8, pending=False, **raw), (1499, [('ablock', 10**8, True)])) # half after the quote expired
+        expired = datetime.datetime.now() - datetime.timedelta(hours=quote_valid_hours, seconds=1)
+        # not expired in the db yet, still half
+        self.assertEqual(self.credit(10**8, pending=True, quote_start_time=expired, **raw), (1499, [('ablock', 10**8, True)]))
+        self.assertEqual(self.credit(4 * 10**7, pending=True, **raw), (0, [('ablock', 10**7, False)])) # underpaid, nothing written
+
+    def test_credit_legacy_float_row(self):
+        legacy = dict(min_amount_ablock=0.3, amount_ablock=0.1) # written before the raw columns existed
+        self.assertEqual(self.credit(7 * 10**7, pending=True, **legacy), (2000, [('ablock', 7 * 10**7, True)]))
+        self.assertEqual(self.credit(7 * 10**7, pending=False, **legacy), (1000, [('ablock', 7 * 10**7, True)]))
+        self.assertEqual(self.credit(10**7 + 1, pending=True, **legacy), (0, [('ablock', 10**7, False)]))
+        address = self.w3.eth.account.create().address
+        payment_id = create_payment('legacy', eth_address=address, pending=True, **legacy)
+        self.helper.load_cursors('eth')
+        self.helper.credit_payments('eth', [(RegistryEntry(payment_id, address), 'ablock', 7 * 10**7)])
+        with db_session:
+            payment = Payment[payment_id]
+            self.assertEqual((payment.amount_ablock_raw, payment.amount_ablock), (7 * 10**7, 0.7))
+
+
+    def test_reorged_checkpoint_rolls_back(self):
+        self.addCleanup(setattr, eth_payments, 'reorg_rollback', eth_payments.reorg_rollback)
+        eth_payments.reorg_rollback = 2
+        with db_session:
+            Payment[self.payment].pending = False # warm, not due again right after a poll
+        self.cycle() # the first cycle polls every address
+        self.w3.provider.ethereum_tester.mine_blocks(5)
+        self.cycle()
+        self.assertNotIn(self.address, self.helper.poll_tiers['eth'].due())
+        cursors = self.helper.cursors['eth']
+        checkpoint = cursors['eth']
+        for name in ['eth_transfer_logs', 'eth_blocks']:
+            cursors[name] = Cursor(checkpoint.block_number, None, None)
+        cursors['eth'] = checkpoint._replace(block_hash='0x' + '00' * 32) # as if the block was reorged away
+        balances, due = self.helper.check_balances('eth')
+        self.assertEqual(sorted(due), sorted(self.helper.accounts['eth']))
+        self.assertIn(self.address, balances[False])
+        for name in ['eth_transfer_logs', 'eth_blocks']:
+            self.assertEqual(cursors[name].block_number, checkpoint.block_number - 2)
+        self.assertEqual(cursors['eth'].block_hash, self.w3.eth.get_block(cursors['eth'].block_number).hash.hex())
+
+    def test_balances_never_read_below_checkpoint(self):
+        self.cycle()
+        head = self.w3.eth.block_number
+        eth_payments.confirmations['eth'] = 3 # the checkpoint is above head - confirmations, e.g. after lowering them
+        self.assertEqual(self.helper.confirmed_block('eth'), (head, False))
+        self.w3.provider.ethereum_tester.mine_blocks(5)
+        self.assertEqual(self.helper.confirmed_block('eth'), (head + 2, False))
+
+    def test_poll_tiers_resume_from_checkpoint(self):
+        with db_session:
+            Payment[self.payment].pending = False
+        self.cycle()
+        self.helper.credit_payments('eth', []) # writes the checkpoint
+        restarted = Web3Helper()
+        restarted.w3['eth'] = self.w3
+        restarted.contract['eth'] = self.token
+        restarted.load_cursors('eth')
+        restarted.fetch_evm_accounts('eth')
+        self.assertIn(self.address, restarted.poll_tiers['eth'].due())
+        checkpoint = restarted.cursors['eth']['eth']
+        restarted.confirmed_block('eth')
+        self.assertNotIn(self.address, restarted.poll_tiers['eth'].due()) # as if polled at the checkpoint time
+        self.assertEqual(restarted.poll_tiers['eth'].states[self.address].last_polled, checkpoint.updated.timestamp())
+
+
+class ChainSupervisorTests(unittest.TestCase):
+    def test_failed_workers_restart_with_backoff(self):
+        supervisor = chain_workers.ChainSupervisor([])
+        self.addCleanup(metrics.registry.remove, metrics.registry[-1])
+        worker = chain_workers.Worker('test')
+        for backoff in [1, 2, 4]:
+            worker.process = chain_workers.context.Process(target=time.sleep, args=(0,))
+            worker.process.start()
+            worker.process.join()
+            start = time.time()
+            supervisor.check(worker)
+            self.assertIsNone(worker.process)
+            self.assertAlmostEqual(worker.restart_at, start + backoff, delta=1)
+            supervisor.check(worker) # not yet due
+            self.assertIsNone(worker.process)
+
+    def test_worker_without_heartbeat_is_stopped(self):
+        supervisor = chain_workers.ChainSupervisor([])
+        self.addCleanup(metrics.registry.remove, metrics.registry[-1])
+        worker = chain_workers.Worker('stalled')
+        worker.process = chain_workers.context.Process(target=time.sleep, args=(60,))
+        worker.process.start()
+        worker.heartbeat.value = time.time()
+        process = worker.process
+        supervisor.check(worker)
+        self.assertIs(worker.process, process)
+        worker.heartbeat.value = time.time() - chain_workers.worker_heartbeat_timeout
+        supervisor.check(worker)
+        self.assertIsNone(worker.process)
+        self.assertFalse(process.is_alive())
+        self.assertEqual(chain_workers.worker_restarts_total.values[('stalled',)], 1)
+
+
+class SharedPricesTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(delete_test_prices)
+
+    def test_saved_prices_are_loaded(self):
+        now = time.time()
+        save_prices(PriceSnapshot({'unittest-eth': 2000.0}, {'unittest-eth': now - 10}))
+        save_prices(PriceSnapshot({'unittest-eth': 2100.0, 'unittest-ablock': 0.5}, {'unittest-eth': now, 'unittest-ablock': now}))
+        snapshot = load_prices()
+        self.assertEqual((snapshot.price('unittest-eth'), snapshot.times['unittest-eth']), (2100.0, now))
+        self.assertEqual(snapshot.price('unittest-ablock'), 0.5)
+
+
+class RpcBatchTests(unittest.TestCase):
+    """Sends batch requests to eth-tester served over JSON-RPC http by a local server,
+    which replies to each batch in reverse order, like a node may."""
+
+    def setUp(self):
+        self.w3 = w3 = Web3(EthereumTesterProvider())
+        self.token = deploy_contract(self.w3, 'ERC20', 'aBLOCK', 8, 10**16)
+        self.owner = self.w3.eth.accounts[0]
+        self.addresses = [self.w3.eth.account.create().address for _ in range(7)]
+        self.posts = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(handler):
+                body = json.loads(handler.rfile.read(int(handler.headers['Content-Length'])))
+                self.posts.append(len(body))
+                replies = []
+                for call in body:
+                    try:
+                        result = w3.manager.request_blocking(call['method'], call['params'])
+                        reply = {'result': hex(result) if type(result) is int else json.loads(Web3.toJSON(result))}
+                    except Exception as e:
+                        reply = {'error': {'code': -32000, 'message': str(e)}}
+                    reply.update({'jsonrpc': '2.0', 'id': call['id']})
+                    replies.append(reply)
+                data = json.dumps(replies[::-1]).encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'application/json')
+                handler.send_header('Content-Length', str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.endpoint_uri = f'http://127.0.0.1:{server.server_address[1]}'
+
+    def test_results_keep_call_order_across_chunks(self):
+        for i, address in enumerate(self.addresses):
+            self.w3.eth.send_transaction({'from': self.owner, 'to': address, 'value': (i + 1) * 10**15})
+        results = batch_request(self.endpoint_uri, [('eth_getBalance', [address, 'latest']) for address in self.addresses], chunk_size=3)
+        self.assertEqual([int(result, 16) for result in results], [(i + 1) * 10**15 for i in range(7)])
+        self.assertEqual(self.posts, [3, 3, 1])
+
+    def test_failed_call_raises(self):
+        calls = [('eth_getBalance', [address, 'latest']) for address in self.addresses]
+        calls[4] = ('eth_getBalance', ['0x1234', 'latest']) # not an address
+        with self.assertRaises(BatchRequestError):
+            batch_request(self.endpoint_uri, calls, chunk_size=3)
+        self.assertEqual(self.posts, [3, 3]) # stopped at the chunk of the failed call
+
+    def test_check_balance_batched(self):
+        self.addCleanup(setattr, rpc_batch, 'rpc_batch_size', rpc_batch.rpc_batch_size)
+        self.addCleanup(eth_payments.block_contract_address.__setitem__, 'eth', eth_payments.block_contract_address['eth'])
+        rpc_batch.rpc_batch_size = 4
+        eth_payments.block_contract_address['eth'] = self.token.address
+        for i, address in enumerate(self.addresses[:5]):
+            self.w3.eth.send_transaction({'from': self.owner, 'to': address, 'value': (i + 1) * 10**15})
+            self.token.functions.transfer(address, (i % 2) * 10**8).transact({'from': self.owner})
+        block = self.w3.eth.block_number
+        self.w3.eth.send_transaction({'from': self.owner, 'to': self.addresses[0], 'value': 10**18}) # after the block read
+        helper = Web3Helper()
+        helper.w3['eth'] = Web3(Web3.HTTPProvider(self.endpoint_uri))
+        helper.contract['eth'] = self.token
+        self.assertEqual(helper.check_balance_batched('eth', True, self.addresses, block),
+                         {address: (i + 1) * 10**15 for i, address in enumerate(self.addresses[:5])})
+        self.assertEqual(helper.check_balance_batched('eth', False, self.addresses, block),
+                         {address: 10**8 for address in self.addresses[1:5:2]})
+        self.assertEqual(self.posts, [4, 3, 4, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import time
+import datetime
+import logging
+from database.models import Payment, select, db_session
+from util.metrics import db_session_seconds
+from util.units import to_raw
+
+registry_full_reload = int(os.environ.get('REGISTRY_FULL_RELOAD', 3600)) # seconds between full reloads of the deposit address registry
+registry_overlap = int(os.environ.get('REGISTRY_OVERLAP', 60)) # seconds before the newest quote_start_time seen that a refresh fetches again
+registry_overlap_ids = int(os.environ.get('REGISTRY_OVERLAP_IDS', 100)) # payment ids below the highest id seen that a refresh fetches again
+
+
+# returns the base units of a payment amount, from its float column for rows written before the raw columns existed
+def raw_amount(raw, amount, coin_name):
+    if raw is not None:
+        return int(raw)
+    return to_raw(amount or 0, coin_name)
+
+
+class RegistryEntry:
+    __slots__ = ('payment_id', 'address', 'project', 'active', 'pending', 'quote_start_time', 'min_amounts', 'amounts')
+
+    def __init__(self, payment_id, address):
+        self.payment_id = payment_id
+        self.address = address
+        self.project = None
+        self.active = False
+        self.pending = False
+        self.quote_start_time = None
+        self.min_amounts = {} # coin_name => min amount quoted, in base units
+        self.amounts = {} # coin_name => amount last credited/recorded in the db, in base units
+
+
+class AddressRegistry:
+    """In-memory map of the deposit addresses of one chain, normalized to lowercase,
+    to their payment id, min amounts and last recorded amounts. Loaded in full once,
+    then only rows with a new id or a newer quote_start_time are fetched, with a full
+    reload every registry_full_reload seconds to pick up other changes. Rows inserted
+    by several api processes at once can commit out of id and time order, so each
+    refresh fetches again the last registry_overlap_ids ids and registry_overlap
+    seconds of quotes, and skips the rows it already has."""
+
+    def __init__(self, evm, coin_names):
+        self.evm = evm
+        self.coin_names = coin_names # [native coin name, block token name]
+        self.entries = {}
+        self.max_id = 0
+        self.max_quote_start_time = datetime.datetime.min
+        self.last_full_reload = None
+
+    # returns the addresses of the fetched rows that were new or changed
+    @db_session_seconds.time('registry_refresh')
+    @db_session
+    def refresh(self):
+        full_reload = self.last_full_reload is None or time.time() - self.last_full_reload > registry_full_reload
+        max_id = 0 if full_reload else self.max_id - registry_overlap_ids
+        since = datetime.datetime.min if full_reload or self.max_quote_start_time == datetime.datetime.min \
+            else self.max_quote_start_time - datetime.timedelta(seconds=registry_overlap)
+        native, block = self.coin_names
+        # select only the columns needed for crediting, never the privkeys
+        rows = select(f'(p.id, p.{self.evm}_address, p.project.name, p.project.active, p.pending, p.quote_start_time, '
+                      f'p.min_amount_{native}, p.min_amount_{block}, p.amount_{native}, p.amount_{block}, '
+                      f'p.min_amount_{native}_raw, p.min_amount_{block}_raw, p.amount_{native}_raw, p.amount_{block}_raw) '
+                      f'for p in Payment if p.{self.evm}_address != "" and (p.id > max_id or p.quote_start_time > since)')[:]
+        entries = {} if full_reload else self.entries
+        fetched = []
+        for payment_id, address, project, active, pending, quote_start_time, min_native, min_block, amount_native, amount_block, \
+                min_native_raw, min_block_raw, amount_native_raw, amount_block_raw in rows:
+            known = entries.get(address.lower())
+            if known is not None and known.payment_id == payment_id and known.quote_start_time == quote_start_time:
+                continue # fetched again by the overlap, the registry copy may hold newer amounts
+            fetched.append(address)
+            entry = RegistryEntry(payment_id, address)
+            entry.project = project
+            entry.active = active
+            entry.pending = bool(pending)
+            entry.quote_start_time = quote_start_time
+            entry.min_amounts = {native: raw_amount(min_native_raw, min_native, native), block: raw_amount(min_block_raw, min_block, block)}
+            entry.amounts = {native: raw_amount(amount_native_raw, amount_native, native), block: raw_amount(amount_block_raw, amount_block, block)}
+            entries[address.lower()] = entry
+            self.max_id = max(self.max_id, payment_id)
+            self.max_quote_start_time = max(self.max_quote_start_time, quote_start_time)
+        self.entries = entries
+        if full_reload:
+            self.last_full_reload = time.time()
+        logging.info(f'{self.evm} address registry: {"reloaded" if full_reload else "fetched"} {len(fetched)} rows, {len(entries)} addresses')
+        return fetched
+
+    def get(self, address):
+        return self.entries.get(address.lower())
+
+    def addresses(self):
+        return [entry.address for entry in self.entries.values()]
+
+    # returns rows of (address, pending, project active, quote_start_time as unix time) for PollTiers.update
+    def poll_rows(self):
+        return [(entry.address, entry.pending, entry.active, entry.quote_start_time.timestamp()) for entry in self.entries.values()]
@@ -0,0 +1,105 @@
+import os
+import time
+import logging
+import itertools
+from collections import Counter, deque
+from database.models import db, db_session
+from util.metrics import db_session_seconds
+
+# 'memory': each process flushes its counts straight into the project table
+# 'postgres': each process appends its counts to the apiusage table, which one process at a time rolls up into the project table;
+#             use this when running several worker processes
+api_count_backend = os.environ.get('API_COUNT_BACKEND', 'memory')
+rollup_lock_key = 7036151 # pg advisory lock key held while rolling up apiusage
+
+
+class ApiCounter:
+    """Counts api calls per project without locks or lost increments. Request threads
+    only append the project id to a deque (an atomic operation), and the flush thread
+    drains it with popleft, so every increment is either part of this flush or of the
+    next one. A flush applies all counts with one bulk UPDATE that also deactivates
+    projects which ran out of api tokens, or with the postgres backend appends them
+    to the apiusage table and rolls that up into the project table."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or api_count_backend
+        self.calls = deque()
+        self.counts = {} # project id => itertools.count of the calls since the last drain, for the api_count responses
+        self.unflushed = Counter() # counts drained by a flush that failed, retried on the next flush
+        self.flushed = time.time() # time of the last successful flush
+
+    # returns the number of calls of project_id counted by this process since the last flush, this one included
+    def increment(self, project_id):
+        self.calls.append(project_id)
+        return next(self.counts.setdefault(project_id, itertools.count(1))) # next() of a count is atomic, like the append
+
+    # returns Counter of project id => number of calls since the last drain
+    def drain(self):
+        self.counts = {}
+        counts = Counter()
+        try:
+            while True:
+                counts[self.calls.popleft()] += 1
+        except IndexError:
+            pass
+        return counts
+
+    def flush(self):
+        """Adds the counted api calls to project.used_api_tokens. Should only be called
+        from a unique thread."""
+        counts = self.drain()
+        counts.update(self.unflushed)
+        self.unflushed = Counter()
+        if self.backend == 'postgres':
+            try:
+                if counts:
+                    self.append_usage(list(counts.keys()), list(counts.values()))
+            except Exception as e:
+                self.unflushed = counts
+                raise
+            counts, updated = self.rollup()
+        elif not counts:
+            self.flushed = time.time()
+            return []
+        else:
+            try:
+                updated = self.update_db(list(counts.keys()), list(counts.values()))
+            except Exception as e:
+                self.unflushed = counts
+                raise
+        for name, used_api_tokens, active in updated:
+            logging.info('updating {} with {}'.format(name, counts[name]))
+        self.flushed = time.time()
+        return updated
+
+    @db_session_seconds.time('api_count_update')
+    @db_session
+    def update_db(self, names, counts):
+        cursor = db.execute('''UPDATE project
+                               SET used_api_tokens = coalesce(used_api_tokens, 0) + v.n,
+                                   active = CASE WHEN coalesce(used_api_tokens, 0) + v.n >= api_token_count THEN false ELSE active END
+                               FROM unnest($names::text[], $counts::bigint[]) AS v(name, n)
+                               WHERE project.name = v.name
+                               RETURNING project.name, project.used_api_tokens, project.active''')
+        return cursor.fetchall()
+
+    @db_session_seconds.time('api_count_append')
+    @db_session
+    def append_usage(self, names, counts):
+        db.execute('INSERT INTO apiusage (project, calls) SELECT * FROM unnest($names::text[], $counts::bigint[])')
+
+    # returns (Counter of project name => calls rolled up, updated project rows); does nothing while another process holds the rollup lock
+    @db_session_seconds.time('api_count_rollup')
+    @db_session
+    def rollup(self):
+        cursor = db.execute('''WITH locked AS (SELECT pg_try_advisory_xact_lock($rollup_lock_key) AS locked),
+                                    usage AS (DELETE FROM apiusage WHERE (SELECT locked FROM locked) RETURNING project, calls),
+                                    totals AS (SELECT project AS name, sum(calls) AS n FROM usage GROUP BY project)
+                               UPDATE project
+                               SET used_api_tokens = coalesce(used_api_tokens, 0) + totals.n,
+                                   active = CASE WHEN coalesce(used_api_tokens, 0) + totals.n >= api_token_count THEN false ELSE active END
+                               FROM totals
+                               WHERE project.name = totals.name
+                               RETURNING project.name, project.used_api_tokens, project.active, totals.n''')
+        rows = cursor.fetchall()
+        return Counter({name: n for name, used_api_tokens, active, n in rows}), [row[:3] for row in rows]
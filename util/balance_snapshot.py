@@ -0,0 +1,43 @@
+class BalanceSnapshot:
+    """Last seen raw balances of the deposit addresses of one chain, so a cycle only
+    handles the addresses whose balance moved since they were last polled. Each
+    address gets a slot the first time it is seen; the evm coin and block token
+    balances are kept in two integer lists indexed by slot, None until the address
+    has been polled."""
+
+    def __init__(self):
+        self.slots = {} # lowercase address => slot
+        self.balances = {True: [], False: []} # evm_coin_block_token_ => last seen balance of each slot
+
+    def slot(self, address):
+        key = address.lower()
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.balances[True])
+            self.balances[True].append(None)
+            self.balances[False].append(None)
+        return slot
+
+    # balances is a dict of evm_coin_block_token_ => dict of addr => polled balance
+    # returns list of (addr, evm_coin_block_token_, balance) of the balances that differ from the last seen ones
+    def changes(self, balances):
+        changed = []
+        for evm_coin_block_token_, polled in balances.items():
+            seen = self.balances[evm_coin_block_token_]
+            for address, balance in polled.items():
+                if seen[self.slot(address)] != balance:
+                    changed.append((address, evm_coin_block_token_, balance))
+        return changed
+
+    # records the balances of changes as seen, once they have been handled
+    def update(self, changes):
+        for address, evm_coin_block_token_, balance in changes:
+            self.balances[evm_coin_block_token_][self.slot(address)] = balance
+
+    # makes the next poll of addresses count as a change, e.g. after their min amounts changed
+    def forget(self, addresses):
+        for address in addresses:
+            slot = self.slots.get(address.lower())
+            if slot is not None:
+                self.balances[True][slot] = None
+                self.balances[False][slot] = None
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from util import metrics, leader, rpc_budget
+
+chain_workers = os.environ.get('CHAIN_WORKERS', 'false').lower() == 'true' # run each chain's payment processing in its own process
+worker_heartbeat_timeout = int(os.environ.get('WORKER_HEARTBEAT_TIMEOUT', 600)) # seconds without a successful cycle after which a chain worker is restarted
+worker_backoff = int(os.environ.get('WORKER_BACKOFF', 1)) # seconds to wait before the first restart of a failed chain worker
+worker_backoff_max = int(os.environ.get('WORKER_BACKOFF_MAX', 300)) # max seconds between restarts of a failing chain worker
+worker_shutdown_grace = int(os.environ.get('WORKER_SHUTDOWN_GRACE', 30)) # seconds a stopping chain worker gets to finish its cycle
+worker_rpc_share = float(os.environ.get('WORKER_RPC_SHARE', 0.8)) # share of a chain's rpc budget given to its worker, the server process keeps the rest
+supervise_interval = 1 # seconds between health checks of the chain workers
+
+if not 0 < worker_rpc_share < 1:
+    raise ValueError(f'WORKER_RPC_SHARE must be between 0 and 1, got {worker_rpc_share}')
+
+# spawned, not forked: the workers must not inherit the db connections, sockets and locks of the server's threads
+context = multiprocessing.get_context('spawn')
+
+worker_restarts_total = metrics.Counter('chain_worker_restarts_total', 'Restarts of the chain worker processes', ['chain'])
+
+
+# returns the leader lock pid of this process as stored in a shared value, -1 for None
+def shared_lock_pid():
+    return -1 if leader.lock_pid is None else leader.lock_pid
+
+
+def run_worker(evm, heartbeat, lock_pid):
+    """Entry point of a chain worker process: runs the payment processing loop of evm
+    in a thread and writes the time of each successful cycle to heartbeat. lock_pid
+    mirrors the leader lock state of the supervising process, so the worker pauses
+    and stops crediting with it. On SIGTERM
+    the current cycle is allowed to finish, for at most worker_shutdown_grace
+    seconds, before the process exits. Exits at once, without finishing its cycle,
+    when the supervising process is gone, so an orphaned worker never credits
+    payments next to a new leader."""
+    logging.basicConfig(level=os.environ.get('LOGLEVEL', 'INFO').upper(), stream=sys.stdout,
+                        format=f'%(asctime)s %(levelname)s - {evm} worker - %(message)s',
+                        datefmt='[%Y-%m-%d:%H:%M:%S]', force=True)
+    from util.eth_payments import Web3Helper
+    rpc_budget.set_share(evm, worker_rpc_share)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # a ctrl-c reaches the whole process group, the supervisor stops the workers
+    parent = os.getppid()
+
+    def beat():
+        heartbeat.value = time.time()
+
+    def follow_leader():
+        leader.lock_pid = None if lock_pid.value < 0 else lock_pid.value
+
+    if metrics.metrics_dir:
+        threading.Thread(target=metrics.run_writer, daemon=True).start()
+    helper = Web3Helper()
+    beat()
+    follow_leader()
+    loop = threading.Thread(target=helper.evm_start, daemon=True, args=[evm, beat])
+    loop.start()
+    while not stopping.wait(supervise_interval):
+        follow_leader()
+        if not loop.is_alive():
+            logging.critical(f'{evm} payment processing loop stopped')
+            sys.exit(1)
+        if os.getppid() != parent:
+            # no grace: a new leader may already be crediting, and a cycle of this worker could credit next to it
+            logging.critical(f'supervisor of the {evm} worker is gone, exiting')
+            os._exit(1)
+    # never released: the loop thread blocks before its next cycle until the process exits
+    if not helper.cycle_lock[evm].acquire(timeout=worker_shutdown_grace):
+        logging.warning(f'{evm} cycle still running after {worker_shutdown_grace}s, exiting anyway')
+    logging.info(f'{evm} worker stopped')
+
+
+class Worker:
+    def __init__(self, evm):
+        self.evm = evm
+        self.process = None
+        self.heartbeat = context.Value('d', 0.0, lock=False) # time of the last heartbeat, written by the worker
+        self.lock_pid = context.Value('q', shared_lock_pid(), lock=False) # leader.lock_pid of the supervisor, -1 for None
+        self.started = 0
+        self.backoff = worker_backoff
+        self.restart_at = 0 # time at which a failed worker is started again
+
+    def start(self):
+        self.heartbeat.value = time.time()
+        self.process = context.Process(target=run_worker, name=f'{self.evm}-worker', args=(self.evm, self.heartbeat, self.lock_pid), daemon=True)
+        self.process.start()
+        self.started = time.time()
+        logging.info(f'started {self.evm} worker, pid {self.process.pid}')
+
+    # returns seconds since the last heartbeat of the worker
+    def heartbeat_age(self):
+        return time.time() - self.heartbeat.value
+
+    def stop(self, timeout):
+        if self.process is None or not self.process.is_alive():
+            return
+        self.process.terminate()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.warning(f'{self.evm} worker did not stop in {timeout}s, killing it')
+            self.process.kill()
+            self.process.join()
+
+
+class ChainSupervisor:
+    """Runs the payment processing loop of each chain in its own worker process, so
+    the chain sweeps don't compete with the api requests for the GIL. A worker that
+    exits, or sends no heartbeat for worker_heartbeat_timeout seconds, is stopped
+    and started again after a backoff that doubles with each failure, up to
+    worker_backoff_max, and resets once a worker stayed up for worker_backoff_max."""
+
+    def __init__(self, evms):
+        self.workers = {evm: Worker(evm) for evm in evms}
+        for evm in evms:
+            rpc_budget.set_share(evm, 1 - worker_rpc_share) # the worker and this process must not each spend the whole rpc budget
+        self.lock = threading.Lock()
+        self.stopped = False
+        metrics.Gauge('chain_worker_heartbeat_age_seconds', 'Seconds since the last heartbeat of each chain worker process',
+                      lambda: {(evm,): worker.heartbeat_age() for evm, worker in self.workers.items() if worker.process is not None}, ['chain'])
+
+    def check(self, worker):
+        now = time.time()
+        worker.lock_pid.value = shared_lock_pid()
+        if worker.process is None:
+            if now >= worker.restart_at:
+                worker.start()
+            return
+        if worker.process.is_alive() and worker.heartbeat_age() < worker_heartbeat_timeout:
+            if now - worker.started >= worker_backoff_max:
+                worker.backoff = worker_backoff
+            return
+        if worker.process.is_alive():
+            logging.critical(f'no heartbeat from {worker.evm} worker in {worker.heartbeat_age():.0f}s, restarting it')
+            worker.stop(worker_shutdown_grace)
+        else:
+            logging.critical(f'{worker.evm} worker exited with code {worker.process.exitcode}, restarting it in {worker.backoff}s')
+        worker_restarts_total.inc(worker.evm)
+        worker.process = None
+        worker.restart_at = now + worker.backoff
+        worker.backoff = min(worker.backoff * 2, worker_backoff_max)
+
+    def run(self):
+        """Starts the workers and keeps them running until stop(). Should be called
+        from a unique thread."""
+        while True:
+            with self.lock:
+                if self.stopped:
+                    return
+                for worker in self.workers.values():
+                    try:
+                        self.check(worker)
+                    except Exception as e:
+                        logging.error(f'supervising {worker.evm} worker failed', exc_info=True)
+            time.sleep(supervise_interval)
+
+    def stop(self):
+        """Lets every worker finish its current cycle and waits for them to exit."""
+        with self.lock:
+            self.stopped = True
+            for worker in self.workers.values():
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self.workers.values():
+                worker.stop(worker_shutdown_grace + supervise_interval)
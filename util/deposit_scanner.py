@@ -0,0 +1,60 @@
+import os
+from web3 import Web3
+from util.rpc_batch import batch_request, rpc_batch_size
+
+scan_token_logs = os.environ.get('SCAN_TOKEN_LOGS', 'false').lower() == 'true' # detect block token deposits from Transfer logs instead of polling every balance
+log_scan_batch_blocks = int(os.environ.get('LOG_SCAN_BATCH_BLOCKS', 2000)) # max block range per eth_getLogs request
+scan_native_blocks = os.environ.get('SCAN_NATIVE_BLOCKS', 'false').lower() == 'true' # detect native coin deposits by scanning new blocks instead of polling every balance
+block_scan_batch_blocks = int(os.environ.get('BLOCK_SCAN_BATCH_BLOCKS', 50)) # max blocks fetched per JSON-RPC batch request
+block_scan_max_blocks = int(os.environ.get('BLOCK_SCAN_MAX_BLOCKS', 1000)) # max blocks scanned per cycle while catching up
+
+transfer_topic = Web3.keccak(text='Transfer(address,address,uint256)').hex()
+
+
+def topic_to_address(topic):
+    return '0x' + bytes(topic[-20:]).hex()
+
+
+def get_transfer_addresses(w3, token_address, from_block, to_block, addresses, batch_blocks=None):
+    """Walks the Transfer logs of token_address over [from_block, to_block] in ranges
+    of batch_blocks and returns the set of addresses (as found in addresses, a dict of
+    lowercase addr => addr) that sent or received tokens."""
+    batch_blocks = batch_blocks or log_scan_batch_blocks
+    hits = set()
+    for start in range(from_block, to_block + 1, batch_blocks):
+        end = min(start + batch_blocks - 1, to_block)
+        logs = w3.eth.get_logs({'fromBlock': start, 'toBlock': end, 'address': token_address, 'topics': [transfer_topic]})
+        for log in logs:
+            if len(log['topics']) < 3:
+                continue
+            for topic in log['topics'][1:3]:
+                address = addresses.get(topic_to_address(topic))
+                if address is not None:
+                    hits.add(address)
+    return hits
+
+
+def get_native_addresses(w3, from_block, to_block, addresses, batch_blocks=None):
+    """Walks the full transactions of blocks [from_block, to_block] and returns the
+    set of addresses (as found in addresses, a dict of lowercase addr => addr) that
+    sent or received a transaction. Blocks are fetched as JSON-RPC batch
+    requests of batch_blocks blocks each on http(s) nodes, unless batching is disabled."""
+    batch_blocks = batch_blocks or block_scan_batch_blocks
+    endpoint_uri = getattr(w3.provider, 'endpoint_uri', None)
+    http = rpc_batch_size > 0 and endpoint_uri is not None and str(endpoint_uri).startswith('http')
+    hits = set()
+    for start in range(from_block, to_block + 1, batch_blocks):
+        numbers = range(start, min(start + batch_blocks - 1, to_block) + 1)
+        if http:
+            blocks = batch_request(endpoint_uri, [('eth_getBlockByNumber', [hex(n), True]) for n in numbers], batch_blocks)
+        else:
+            blocks = [w3.eth.get_block(n, full_transactions=True) for n in numbers]
+        for block in blocks:
+            for tx in block['transactions']:
+                for party in [tx['from'], tx['to']]:
+                    if party is None:
+                        continue # contract creation
+                    address = addresses.get(party.lower())
+                    if address is not None:
+                        hits.add(address)
+    return hits
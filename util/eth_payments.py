@@ -4,17 +4,33 @@ import time
 import json
 import datetime
 import secrets
+import threading
+from collections import namedtuple
 
 from web3 import Web3
-from web3.middleware import geth_poa_middleware
-from database.models import Payment, db_session, commit
+from web3.exceptions import BlockNotFound
+from database.models import Payment, ChainCursor, db_session, commit
 from util import get_eth_amount, get_sys_amount, \
                  get_ablock_amount, get_aablock_amount, get_sysblock_amount, \
                  min_payment_amount_tier1, min_payment_amount_tier2, min_payment_amount_xquery, \
                  discount_ablock, discount_aablock, discount_sysblock, quote_valid_hours, min_api_calls
+from util.rpc_batch import batch_request, rpc_batch_size
+from util.rpc_budget import set_priority
+from util.multicall import aggregate_balances, multicall_abi
+from util.poll_tiers import PollTiers
+from util.address_registry import AddressRegistry, raw_amount
+from util import leader
+from util.key_pool import KeyPool, shared_deposit_key
+from util.providers import get_web3, endpoint_uri
+from util.head_watcher import HeadWatcher
+from util.metrics import cycle_seconds, db_session_seconds
+from util.balance_snapshot import BalanceSnapshot
+from util.units import to_amount
+from util.deposit_scanner import get_transfer_addresses, get_native_addresses, scan_token_logs, scan_native_blocks, \
+                                 block_scan_max_blocks
 
 
-sleep_time = 20 # time to sleep, in seconds, between checking for new web3 payment/withdrawal activity
+sleep_time = 20 # max time to wait, in seconds, for a new block before checking for new web3 payment/withdrawal activity anyway
 
 # create nested dict of names of EVM native coins (coin_names[evm][True]) and block token names (coin_names[evm][False])
 coin_names = {
@@ -31,6 +47,18 @@ coin_names = {
             False:'sysblock'
             }
         }
+# blocks a payment needs on top of it before it is credited; balances are read at head - confirmations
+confirmations = {
+        'eth': int(os.environ.get('ETH_CONFIRMATIONS', 3)),
+        'avax': int(os.environ.get('AVAX_CONFIRMATIONS', 0)), # blocks are final once accepted
+        'nevm': int(os.environ.get('NEVM_CONFIRMATIONS', 2))
+        }
+reorg_rollback = int(os.environ.get('REORG_ROLLBACK_BLOCKS', 64)) # blocks the scan cursors move back when the checkpoint block was reorged away
+checkpoint_interval = int(os.environ.get('CHECKPOINT_INTERVAL', 60)) # max seconds between db writes of the checkpoint and scan cursors when no payments arrive
+
+# in-memory copy of a ChainCursor row
+Cursor = namedtuple('Cursor', ['block_number', 'block_hash', 'updated'])
+
 block_contract_address = {}
 block_contract_address['eth'] = Web3.toChecksumAddress('0xe692c8d72bd4ac7764090d54842a305546dd1de5') # ablock_contract_address 
 block_contract_address['avax'] = Web3.toChecksumAddress('0xC931f61B1534EB21D8c11B24f3f5Ab2471d4aB50') # aablock_contract_address 
@@ -49,128 +77,360 @@ class Web3Helper:
         self.HOST_TYPE = {}
         self.w3 = {}
         self.contract = {}
+        self.multicall = {}
         self.accounts = {}
+        self.registry = {}
+        self.poll_tiers = {}
+        self.snapshot = {}
+        self.cursors = {} # evm => dict of cursor name => Cursor, loaded from the db on the first cycle
+        self.cursors_saved = {} # evm => time the cursors were last written to the db
+        self.key_pool = KeyPool()
+        self.resumed = set() # evms whose poll tiers were resumed from the checkpoint after a restart
+        self.cycle_lock = {} # evm => lock held while a payment processing cycle runs, so a stopping chain worker can let it finish
         for evm in coin_names:
             self.HOST[evm] = os.environ.get(f'{evm.upper()}_HOST','')
             self.PORT[evm] = os.environ.get(f'{evm.upper()}_PORT','')
             self.HOST_TYPE[evm] = os.environ.get(f'{evm.upper()}_HOST_TYPE','')
             self.w3[evm] = None
+            self.multicall[evm] = None
             self.accounts[evm] = []
+            self.registry[evm] = AddressRegistry(evm, [coin_names[evm][True], coin_names[evm][False]])
+            self.poll_tiers[evm] = PollTiers()
+            self.snapshot[evm] = BalanceSnapshot()
+            self.cycle_lock[evm] = threading.Lock()
             if self.HOST[evm]=='': continue
-            url_ext = '/ext/bc/C/rpc' if evm.upper() == 'AVAX' else ''
-            if self.HOST_TYPE[evm] in ['http', 'https']:
-                self.w3[evm] = Web3(Web3.HTTPProvider(f'{self.HOST_TYPE[evm]}://{self.HOST[evm]}:{self.PORT[evm]}{url_ext}'))
-            elif self.HOST_TYPE[evm] in ['ws', 'wss']:
-                self.w3[evm] = Web3(Web3.WebsocketProvider(f'{self.HOST_TYPE[evm]}://{self.HOST[evm]}:{self.PORT[evm]}{url_ext}'))
-            self.w3[evm].middleware_onion.inject(geth_poa_middleware, layer=0)
+            self.w3[evm] = get_web3(evm)
             self.contract[evm] = self.w3[evm].eth.contract(address=block_contract_address[evm], abi=abi)
+            multicall_address = os.environ.get(f'{evm.upper()}_MULTICALL_ADDRESS', '') # e.g. Multicall3 at 0xcA11bde05977b3631167028862bE2a173976CA11
+            if multicall_address != '':
+                self.multicall[evm] = self.w3[evm].eth.contract(address=Web3.toChecksumAddress(multicall_address), abi=multicall_abi)
 
-    def evm_start(self, evm):
+    # heartbeat is called after every successful cycle, and while paused as a follower, when the loop runs in a supervised chain worker (util/chain_workers.py)
+    def evm_start(self, evm, heartbeat=None):
         if self.HOST_TYPE[evm]=='': return # this saves CPU cycles
+        set_priority('deposits') # deposit detection goes first when the rpc budget of the chain runs out
         logging.info(f'{evm.upper()} loop starting in 2s')
         time.sleep(2) # I have no idea why this is here - Conan
+        heads = HeadWatcher(self.w3[evm], endpoint_uri(evm), self.HOST_TYPE[evm])
+        heads.start()
         while True:
-            try:
-                self.fetch_evm_accounts(evm) #  sets self.accounts[evm] to list of all evm addresses which have been created via create_project
-                self.handle_evm_event(evm)
-            except Exception as e:
-                logging.critical(f'error handling {evm}', exc_info=True)
-            logging.info(f'processing {evm} blockchain payments in {sleep_time}s...')
-            time.sleep(sleep_time)
+            if not leader.leading():
+                if heartbeat is not None:
+                    heartbeat() # paused, not stuck
+                time.sleep(leader.leader_retry) # another process may be leader by now
+                continue
+            with self.cycle_lock[evm]:
+                try:
+                    self.fetch_evm_accounts(evm) #  sets self.accounts[evm] to list of all evm addresses which have been created via create_project
+                    self.handle_evm_event(evm)
+                    if heartbeat is not None:
+                        heartbeat() # only finished cycles count, a worker failing every cycle gets restarted
+                except Exception as e:
+                    logging.critical(f'error handling {evm}', exc_info=True)
+            # run the next cycle once a new block arrives, or after sleep_time if none does
+            head = heads.wait_for_new_head(sleep_time)
+            if head is None:
+                logging.info(f'no new {evm} block in {sleep_time}s, processing {evm} blockchain payments')
+            else:
+                logging.debug(f'new {evm} block {head}, processing {evm} blockchain payments')
 
-    @db_session(optimistic=False)
     def fetch_evm_accounts(self, evm):
-        query = Payment.select(eval(f'lambda payment: payment.quote_start_time is not None and payment.{evm}_address is not None and payment.{evm}_address!=""'))
-        accounts = eval(f'[payment.{evm}_address for payment in query]')
-        if len(accounts) > 0:
-            self.accounts[evm] = accounts
-            for payment in query:
-                if payment.pending and datetime.datetime.now() > payment.quote_start_time + datetime.timedelta(hours=quote_valid_hours):
-                    logging.info(f'setting payment.pending = False for project: {payment.project} due to quote time expired.')
-                    payment.pending = False # set pending = False if quote time expired
-
-    def get_evm_address(self, evm, token):
-        if self.w3[evm] is None:
-            return [None, None]
+        fetched = self.registry[evm].refresh() # fetches only new payments and renewed quotes since the last cycle
+        self.snapshot[evm].forget(fetched) # their min amounts may have changed, so look at their balances again
+        self.expire_quotes(evm)
+        self.accounts[evm] = self.registry[evm].addresses()
+        self.poll_tiers[evm].update(self.registry[evm].poll_rows())
+
+    # the db rows are expired by the quote expiry job (util/quote_expiry.py), this only keeps the registry in step with it
+    def expire_quotes(self, evm):
+        for entry in self.registry[evm].entries.values():
+            if entry.pending and datetime.datetime.now() > entry.quote_start_time + datetime.timedelta(hours=quote_valid_hours):
+                entry.pending = False
+
+    # returns dict of evm => [address, privkey] of new deposit keys, [None, None] for evms without a node
+    def get_evm_addresses(self):
+        evms = [evm for evm in coin_names if self.w3[evm] is not None]
         try:
-            acc = self.w3[evm].eth.account.create(token)
-            address = acc.address
-            privkey = acc.privateKey.hex()
-            return [address, privkey]
+            keys = self.key_pool.get_keys(1 if shared_deposit_key else len(evms))
         except Exception as e:
-            logging.critical(f'get {evm.upper()} address exception', exc_info=True)
-            return [None, None]
+            logging.critical('get evm addresses exception', exc_info=True)
+            keys = []
+        addresses = {evm: [None, None] for evm in coin_names}
+        for i, evm in enumerate(evms):
+            if keys:
+                addresses[evm] = list(keys[0 if shared_deposit_key else i])
+        return addresses
+
+    # returns dict of evm_coin_block_token_ => dict of addr => raw balance of every polled address, for both the evm coin and the block token,
+    # and the list of due addresses, to be marked polled once the cycle is committed
+    def check_balances(self, evm):
+        block, rolled_back = self.confirmed_block(evm)
+        # addresses whose hot/warm/cold poll interval elapsed, or all of them after a reorg
+        due = self.poll_tiers[evm].due() if not rolled_back else list(self.accounts[evm])
+        logging.info(f'polling {len(due)} of {len(self.accounts[evm])} {evm} accounts at block {block}, tiers: {self.poll_tiers[evm].counts()}')
+        accounts = {True: due, False: due}
+        if scan_native_blocks:
+            # the due addresses are still polled, catching what the scan can't see, e.g. deposits made by contract calls
+            polled = set(due)
+            accounts[True] = due + [address for address in self.scan_native_blocks(evm, block) if address not in polled]
+        if scan_token_logs:
+            accounts[False] = self.scan_transfer_logs(evm, block)
+        paid = None
+        # multicall reads both balances of the same addresses, so it is used whenever the scans asked for exactly the due ones
+        if self.multicall[evm] is not None and set(accounts[True]) == set(due) and set(accounts[False]) == set(due):
+            try:
+                paid = self.check_balances_multicall(evm, due, block)
+            except Exception as e:
+                logging.warning(f'{evm.upper()} multicall balance lookup failed, falling back to per-address lookup', exc_info=True)
+        if paid is None:
+            paid = {evm_coin_block_token_: self.check_balance(evm, evm_coin_block_token_, accounts[evm_coin_block_token_], block)
+                    for evm_coin_block_token_ in [True, False]}
+        balances = {}
+        for evm_coin_block_token_ in [True, False]:
+            balances[evm_coin_block_token_] = {address: paid[evm_coin_block_token_].get(address, 0) for address in accounts[evm_coin_block_token_]}
+            for address, balance in balances[evm_coin_block_token_].items():
+                self.poll_tiers[evm].observe(address, evm_coin_block_token_, balance)
+        return balances, due
+
+    # reads the checkpoint and scan cursors of evm once; afterwards they are kept in self.cursors and written by save_cursors
+    @db_session
+    def load_cursors(self, evm):
+        names = [evm, f'{evm}_transfer_logs', f'{evm}_blocks']
+        self.cursors[evm] = {cursor.name: Cursor(cursor.block_number, cursor.block_hash or None, cursor.updated)
+                             for cursor in ChainCursor.select(lambda c: c.name in names)}
+        self.cursors_saved[evm] = time.time()
+
+    # writes the cursors of evm to the db, in the caller's db_session
+    def save_cursors(self, evm):
+        for name, (block_number, block_hash, updated) in self.cursors[evm].items():
+            cursor = ChainCursor.get(name=name)
+            if cursor is None:
+                cursor = ChainCursor(name=name, block_number=block_number)
+            cursor.block_number = block_number
+            cursor.block_hash = block_hash or ''
+            cursor.updated = updated
+
+    # returns the block to read balances at, head - confirmations[evm], and whether the checkpoint was rolled back.
+    # The checkpoint holds the last processed block and its hash; if the chain no longer has that block, it was reorged away
+    # and the checkpoint and scan cursors move back reorg_rollback blocks. On the first cycle after a restart, the poll tiers
+    # resume from the checkpoint time instead of polling every address. Like the scan cursors, the checkpoint is only kept
+    # in memory if the cycle fails, and only written to the db together with the payments, or every checkpoint_interval seconds.
+    def confirmed_block(self, evm):
+        cursors = self.cursors[evm]
+        block = max(self.w3[evm].eth.block_number - confirmations[evm], 0)
+        checkpoint = cursors.get(evm)
+        rolled_back = False
+        if checkpoint is not None and checkpoint.block_hash:
+            try:
+                block_hash = self.w3[evm].eth.get_block(checkpoint.block_number).hash.hex()
+            except BlockNotFound:
+                block_hash = None
+            if block_hash != checkpoint.block_hash:
+                rollback_to = max(checkpoint.block_number - reorg_rollback, 0)
+                logging.warning(f'{evm} block {checkpoint.block_number} was reorged away, rescanning from block {rollback_to}')
+                for name in [f'{evm}_transfer_logs', f'{evm}_blocks']:
+                    if name in cursors:
+                        cursors[name] = cursors[name]._replace(block_number=min(cursors[name].block_number, rollback_to))
+                rolled_back = True
+            else:
+                block = max(block, checkpoint.block_number) # never read balances older than already processed ones
+            if evm not in self.resumed and checkpoint.updated is not None:
+                self.poll_tiers[evm].resume(checkpoint.updated.timestamp())
+        self.resumed.add(evm)
+
+        if checkpoint is not None and block == checkpoint.block_number and not rolled_back:
+            block_hash = checkpoint.block_hash # just verified
+        else:
+            block_hash = self.w3[evm].eth.get_block(block).hash.hex()
+        cursors[evm] = Cursor(block, block_hash, datetime.datetime.now())
+        return block, rolled_back
+
+    # returns the block token accounts which sent or received tokens since the last scanned block, scanning up to block
+    def scan_transfer_logs(self, evm, block):
+        cursor = self.cursors[evm].get(f'{evm}_transfer_logs')
+        if cursor is None:
+            logging.info(f'no {evm} transfer log cursor found, checking all {coin_names[evm][False]} balances once')
+            self.cursors[evm][f'{evm}_transfer_logs'] = Cursor(block, None, None)
+            return self.accounts[evm]
+        if block <= cursor.block_number:
+            return []
+        addresses = {address.lower(): address for address in self.accounts[evm]}
+        hits = get_transfer_addresses(self.w3[evm], block_contract_address[evm], cursor.block_number + 1, block, addresses)
+        logging.info(f'{len(hits)} {coin_names[evm][False]} accounts changed in blocks {cursor.block_number + 1}-{block}')
+        self.cursors[evm][f'{evm}_transfer_logs'] = Cursor(block, None, None)
+        return list(hits)
+
+    # returns the evm coin accounts which sent or received a transaction since the last scanned block, scanning up to block but at most
+    # block_scan_max_blocks blocks per cycle while catching up. Balances of hit accounts are read at block, since nodes may not
+    # keep state for the scanned blocks.
+    def scan_native_blocks(self, evm, block):
+        cursor = self.cursors[evm].get(f'{evm}_blocks')
+        if cursor is None:
+            logging.info(f'no {evm} block cursor found, checking all {coin_names[evm][True]} balances once')
+            self.cursors[evm][f'{evm}_blocks'] = Cursor(block, None, None)
+            return self.accounts[evm]
+        if block <= cursor.block_number:
+            return []
+        to_block = min(block, cursor.block_number + block_scan_max_blocks)
+        addresses = {address.lower(): address for address in self.accounts[evm]}
+        hits = get_native_addresses(self.w3[evm], cursor.block_number + 1, to_block, addresses)
+        logging.info(f'{len(hits)} {coin_names[evm][True]} accounts sent or received transactions in blocks {cursor.block_number + 1}-{to_block}')
+        self.cursors[evm][f'{evm}_blocks'] = Cursor(to_block, None, None)
+        return list(hits)
+
+    # reads evm coin and block token balances of all accounts through the multicall aggregator, pinned to a single block
+    def check_balances_multicall(self, evm, accounts, block_identifier='latest'):
+        checksum_accounts = {Web3.toChecksumAddress(address): address for address in accounts}
+        block_identifier = None if block_identifier == 'latest' else block_identifier
+        block_number, native, balances = aggregate_balances(self.multicall[evm], self.contract[evm], checksum_accounts, block_identifier)
+        paid = {True: {}, False: {}}
+        for evm_coin_block_token_, raw_balances in [(True, native), (False, balances)]:
+            for checksum_address, balance in raw_balances.items():
+                if balance > 0:
+                    paid[evm_coin_block_token_][checksum_accounts[checksum_address]] = balance
+        return paid
 
-    # returns dict of addr => addr_value
-    def check_balance(self, evm, evm_coin_block_token_):
+    # returns dict of addr => raw balance, for the accounts with a balance
+    def check_balance(self, evm, evm_coin_block_token_, accounts=None, block_identifier='latest'):
         # evm_coin_block_token_ = True if checking balance of evm coin, False if checking balance of block token on evm
+        accounts = self.accounts[evm] if accounts is None else accounts
+        if rpc_batch_size > 0 and self.HOST_TYPE[evm] in ['http', 'https']:
+            try:
+                return self.check_balance_batched(evm, evm_coin_block_token_, accounts, block_identifier)
+            except Exception as e:
+                logging.warning(f'batched {evm.upper()} balance lookup failed, falling back to per-address lookup', exc_info=True)
         paid = {}
-        for address in self.accounts[evm]:
+        for address in accounts:
             if evm_coin_block_token_:
-                balance = self.w3[evm].eth.getBalance(Web3.toChecksumAddress(address))
-                amount = float(Web3.fromWei(balance, 'ether'))
+                balance = self.w3[evm].eth.getBalance(Web3.toChecksumAddress(address), block_identifier)
             else:
-                balance_contract = self.contract[evm].functions.balanceOf(Web3.toChecksumAddress(address)).call()
-                amount = float(Web3.fromWei(balance_contract*10**10, 'ether'))
-            if amount > 0:
-                paid[address] = amount
+                balance = self.contract[evm].functions.balanceOf(Web3.toChecksumAddress(address)).call(block_identifier=block_identifier)
+            if balance > 0:
+                paid[address] = balance
+        return paid
+
+    # same as check_balance, but sends all balance queries as JSON-RPC batch requests of rpc_batch_size calls each
+    def check_balance_batched(self, evm, evm_coin_block_token_, accounts, block_identifier='latest'):
+        accounts = list(accounts)
+        block_identifier = hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+        calls = []
+        for address in accounts:
+            if evm_coin_block_token_:
+                calls.append(('eth_getBalance', [Web3.toChecksumAddress(address), block_identifier]))
+            else:
+                data = self.contract[evm].encodeABI(fn_name='balanceOf', args=[Web3.toChecksumAddress(address)])
+                calls.append(('eth_call', [{'to': block_contract_address[evm], 'data': data}, block_identifier]))
+        results = batch_request(self.w3[evm].provider.endpoint_uri, calls)
+        paid = {}
+        for address, result in zip(accounts, results):
+            balance = int(result, 16)
+            if balance > 0:
+                paid[address] = balance
         return paid
 
 
-    @db_session()
     def handle_evm_event(self, evm):
+        """Polls the due balances of evm and credits the payments. Only balances which
+        moved since they were last seen are looked at, and the db is only touched for
+        amounts that have to be written, so a cycle without payments does no db work.
+        The cursors are written along with the payments, or every checkpoint_interval
+        seconds."""
+        with cycle_seconds.time(evm):
+            if evm not in self.cursors:
+                self.load_cursors(evm)
+            cursors = dict(self.cursors[evm])
+            try:
+                balances, due = self.check_balances(evm)
+                changes = self.snapshot[evm].changes(balances)
+                credits = self.get_credits(evm, changes)
+                updates = []
+                if credits or time.time() - self.cursors_saved[evm] >= checkpoint_interval:
+                    updates = self.credit_payments(evm, credits)
+                    self.cursors_saved[evm] = time.time()
+            except Exception as e:
+                self.cursors[evm] = cursors # scan the blocks of this cycle again on the next one
+                raise
+            # only update the registry, the snapshot and the poll times once the new amounts are committed
+            for entry, coin_name, value, active in updates:
+                entry.amounts[coin_name] = value
+                entry.active = active
+            self.snapshot[evm].update(changes)
+            self.poll_tiers[evm].mark_polled(due) # a failed cycle leaves them due, so they are polled again on the next one
 
-        def update_db_amount(coin_name, payment_obj, value):
-            if coin_name == 'avax':
-                payment_obj.amount_avax = float(value)
-            elif coin_name == 'aablock':
-                payment_obj.amount_aablock = float(value)
-            elif coin_name == 'sys':
-                payment_obj.amount_sys = float(value)
-            elif coin_name == 'sysblock':
-                payment_obj.amount_sysblock = float(value)
-            elif coin_name == 'eth':
-                payment_obj.amount_eth = float(value)
-            elif coin_name == 'ablock':
-                payment_obj.amount_ablock = float(value)
-
-        # evm_coin_block_token_ = True if checking balance of evm native coin, False if checking balance of block token on evm
-        for evm_coin_block_token_ in [True, False]:
-            accounts = self.check_balance(evm, evm_coin_block_token_) # stores dict of addr => addr_value in accounts var
+    # returns list of (registry entry, coin_name, value) of the changed balances that have to be written to the db, judged by the
+    # registry copy of the payment. Everything is compared in integer base units, so crediting is exact for any number of token decimals
+    def get_credits(self, evm, changes):
+        credits = []
+        for to_address, evm_coin_block_token_, balance in changes:
+            # evm_coin_block_token_ = True if checking balance of evm native coin, False if checking balance of block token on evm
             coin_name = coin_names[evm][evm_coin_block_token_]
-            logging.info(f'processing {coin_name} payments...')
-            for to_address in accounts:
-                payment_obj = eval(f'Payment.get({evm}_address=to_address)')
-                min_amount = eval(f'payment_obj.min_amount_{coin_name}')
-                if min_amount <= 0:
-                    continue # SNode op may have set min_amount to 0 to allow free access; this continue prevents division by 0 below
-
-                value = accounts[to_address]
-                value_added = value - eval(f'payment_obj.amount_{coin_name}')
-                if value_added >= min_amount:
-                    logging.info('{} {} payment received for project: {} at address: {}'.format(value_added, coin_name, payment_obj.project.name, to_address))
-
-                    # If payment quote still valid/pending, add to api_token_count according to amount paid
-                    if payment_obj.pending:
-                        payment_obj.project.api_token_count += int(value_added * min_api_calls / min_amount)
-                    # If payment quote NOT still valid/pending, add half of quoted api calls to api_token_count, according to amount paid / 2
-                    else:
-                        payment_obj.project.api_token_count += int(value_added * min_api_calls / min_amount / 2)
-
-                    # Only set the project to active if the user has
-                    # more api tokens available than used api tokens.
-                    if payment_obj.project.api_token_count > payment_obj.project.used_api_tokens:
-                        payment_obj.project.active = True
-                        payment_obj.project.activated = True
-
-                    update_db_amount(coin_name, payment_obj, value)
-
-                elif value_added > 0:
-                    logging.info('{} {} payment received for project: {} at address: {} was too low'.format(value_added, coin_name, payment_obj.project.name,
-                                                                                 to_address))
-                    logging.info('min {} payment for project: {} is {} but only {} was received'.format(coin_name, payment_obj.project.name,
-                                                                                     min_amount, value_added))
-                elif value_added < 0:
-                    logging.info('{} {} withdrawn from project: {} address: {} by SNode operator'.format(abs(value_added), coin_name, payment_obj.project.name,
-                                                                                 to_address))
-                    update_db_amount(coin_name, payment_obj, value)
+            entry = self.registry[evm].get(to_address)
+            if entry is None:
+                continue
+            min_amount = entry.min_amounts[coin_name]
+            if min_amount <= 0:
+                continue # SNode op may have set min_amount to 0 to allow free access; this continue prevents division by 0 in credit_payments
+
+            value_added = balance - entry.amounts[coin_name]
+            if value_added >= min_amount or value_added < 0:
+                credits.append((entry, coin_name, balance))
+            elif value_added > 0:
+                logging.info('{} {} payment received for project: {} at address: {} was too low'.format(to_amount(value_added, coin_name), coin_name,
+                                                                             entry.project, to_address))
+                logging.info('min {} payment for project: {} is {} but only {} was received'.format(coin_name, entry.project,
+                                                                                 to_amount(min_amount, coin_name), to_amount(value_added, coin_name)))
+        return credits
+
+    # returns list of (registry entry, coin_name, value, project active) for every amount written to or read from the db.
+    # The amounts credited are computed from the payment rows, locked for update, so a payment is credited once even if
+    # another process credited it since the registry was loaded
+    @db_session_seconds.time('credit_payments')
+    @db_session()
+    def credit_payments(self, evm, credits):
+        if not leader.holds_lock():
+            raise leader.LeaderLockLost(f'leader lock lost, not crediting {evm} payments')
+
+        # value is in base units; the float column is kept for api responses
+        def update_db_amount(coin_name, payment_obj, value):
+            setattr(payment_obj, f'amount_{coin_name}_raw', value)
+            setattr(payment_obj, f'amount_{coin_name}', to_amount(value, coin_name))
+
+        updates = []
+        for entry, coin_name, value in credits:
+            payment_obj = Payment.get_for_update(id=entry.payment_id)
+            if not payment_obj:
+                continue
+            min_amount = raw_amount(getattr(payment_obj, f'min_amount_{coin_name}_raw'), getattr(payment_obj, f'min_amount_{coin_name}'), coin_name)
+            recorded = raw_amount(getattr(payment_obj, f'amount_{coin_name}_raw'), getattr(payment_obj, f'amount_{coin_name}'), coin_name)
+            value_added = value - recorded
+            if min_amount <= 0 or 0 <= value_added < min_amount:
+                updates.append((entry, coin_name, recorded, payment_obj.project.active)) # nothing (more) to credit, keep the registry in step
+                continue
+            if value_added > 0:
+                logging.info('{} {} payment received for project: {} at address: {}'.format(to_amount(value_added, coin_name), coin_name,
+                                                                                             payment_obj.project.name, entry.address))
+
+                # the expiry job may not have expired the row yet, e.g. for a quote made by another process since its last resync
+                if payment_obj.pending and datetime.datetime.now() > payment_obj.quote_start_time + datetime.timedelta(hours=quote_valid_hours):
+                    logging.info(f'setting payment.pending = False for project: {payment_obj.project.name} due to quote time expired.')
+                    payment_obj.pending = False
+
+                # If payment quote still valid/pending, add to api_token_count according to amount paid
+                if payment_obj.pending:
+                    payment_obj.project.api_token_count += value_added * min_api_calls // min_amount
+                # If payment quote NOT still valid/pending, add half of quoted api calls to api_token_count, according to amount paid / 2
+                else:
+                    payment_obj.project.api_token_count += value_added * min_api_calls // (min_amount * 2)
+
+                # Only set the project to active if the user has
+                # more api tokens available than used api tokens.
+                if payment_obj.project.api_token_count > payment_obj.project.used_api_tokens:
+                    payment_obj.project.active = True
+                    payment_obj.project.activated = True
+            else:
+                logging.info('{} {} withdrawn from project: {} address: {} by SNode operator'.format(to_amount(-value_added, coin_name), coin_name,
+                                                                             payment_obj.project.name, entry.address))
+            update_db_amount(coin_name, payment_obj, value)
+            updates.append((entry, coin_name, value, payment_obj.project.active))
+        self.save_cursors(evm)
+        return updates
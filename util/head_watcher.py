@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import websockets
+
+head_poll_interval = float(os.environ.get('HEAD_POLL_INTERVAL', 2)) # seconds between eth_blockNumber polls of http(s) nodes
+head_debounce = float(os.environ.get('HEAD_DEBOUNCE', 0.5)) # seconds to wait after a new head so a burst of heads triggers one cycle
+head_resubscribe = 5 # seconds to wait before reconnecting a dropped newHeads subscription
+
+
+class HeadWatcher:
+    """Tells a chain processing loop when the chain head advanced. On ws(s) nodes
+    a background thread holds an eth_subscribe('newHeads') subscription on its own
+    connection; on http(s) nodes wait_for_new_head polls eth_blockNumber every
+    head_poll_interval seconds, which is far cheaper than a full cycle."""
+
+    def __init__(self, w3, uri, host_type):
+        self.w3 = w3
+        self.uri = uri
+        self.subscribe = host_type in ['ws', 'wss']
+        self.head = None # last head seen
+        self.seen = None # last head returned by wait_for_new_head
+        self.condition = threading.Condition()
+
+    def start(self):
+        if self.subscribe:
+            threading.Thread(target=self.run_subscription, daemon=True).start()
+
+    def set_head(self, number):
+        with self.condition:
+            if self.head is None or number > self.head:
+                self.head = number
+                self.condition.notify_all()
+
+    async def read_heads(self):
+        async with websockets.connect(self.uri) as ws:
+            await ws.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']}))
+            reply = json.loads(await ws.recv())
+            if 'error' in reply:
+                raise ValueError(f'newHeads subscription failed: {reply["error"]}')
+            logging.info(f'subscribed to new heads of {self.uri}')
+            async for message in ws:
+                self.set_head(int(json.loads(message)['params']['result']['number'], 16))
+
+    def run_subscription(self):
+        """Keeps the newHeads subscription open forever. Should be called from a
+        unique thread."""
+        while True:
+            try:
+                asyncio.run(self.read_heads())
+            except Exception as e:
+                logging.warning(f'newHeads subscription of {self.uri} dropped', exc_info=True)
+            time.sleep(head_resubscribe)
+
+    def wait_for_new_head(self, timeout):
+        """Blocks until the head advanced past the head returned by the previous call,
+        or timeout seconds passed. Returns the new head, None on timeout."""
+        deadline = time.time() + timeout
+        if self.subscribe:
+            with self.condition:
+                self.condition.wait_for(lambda: self.head is not None and self.head != self.seen, timeout=timeout)
+        else:
+            while time.time() < deadline:
+                try:
+                    self.set_head(self.w3.eth.block_number)
+                except Exception as e:
+                    logging.warning(f'eth_blockNumber of {self.uri} failed', exc_info=True)
+                if self.head is not None and self.head != self.seen:
+                    break
+                time.sleep(max(min(head_poll_interval, deadline - time.time()), 0))
+        with self.condition:
+            if self.head is None or self.head == self.seen:
+                return None
+            self.seen = self.head
+        time.sleep(head_debounce)
+        return self.seen
@@ -0,0 +1,109 @@
+import os
+import hashlib
+import logging
+import threading
+from Crypto.Cipher import AES
+from eth_account import Account
+from database.models import db, db_session
+from util.metrics import db_session_seconds
+
+deposit_key_secret = os.environ.get('DEPOSIT_KEY_SECRET', '') # enables the deposit key pool; pooled keys are encrypted with a key derived from it
+key_pool_low = int(os.environ.get('KEY_POOL_LOW', 100)) # refill the pool when it holds fewer keys than this
+key_pool_high = int(os.environ.get('KEY_POOL_HIGH', 1000)) # number of keys the pool is refilled to
+key_pool_check = int(os.environ.get('KEY_POOL_CHECK', 30)) # max seconds between pool size checks
+shared_deposit_key = os.environ.get('SHARED_DEPOSIT_KEY', 'false').lower() == 'true' # one deposit keypair for all evm chains of a project
+key_pool_batch = 100 # keys generated and inserted per statement
+
+
+def derive_key(secret):
+    return hashlib.scrypt(secret.encode(), salt=b'eth-payment-processor deposit keys', n=2**14, r=8, p=1, dklen=32)
+
+
+class KeyPool:
+    """Pool of pre-generated deposit keypairs in the depositkey table, so creating
+    a project claims ready keys instead of generating them while the client waits.
+    Private keys are stored AES-GCM encrypted with a key derived from
+    DEPOSIT_KEY_SECRET and decrypted when claimed; without a secret the pool is
+    disabled and keys are generated on claim. A claimed row is deleted in the same
+    statement that selects it, so concurrent workers never get the same key."""
+
+    def __init__(self, secret=None, low=None, high=None):
+        secret = deposit_key_secret if secret is None else secret
+        self.key = derive_key(secret) if secret else None
+        self.low = low or key_pool_low
+        self.high = high or key_pool_high
+        self.wake = threading.Event()
+
+    def enabled(self):
+        return self.key is not None
+
+    # returns hex of nonce + tag + ciphertext
+    def encrypt(self, privkey):
+        cipher = AES.new(self.key, AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(privkey)
+        return (cipher.nonce + tag + ciphertext).hex()
+
+    # returns the 0x prefixed hex private key
+    def decrypt(self, encrypted):
+        data = bytes.fromhex(encrypted)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=data[:16])
+        return '0x' + cipher.decrypt_and_verify(data[32:], data[16:32]).hex()
+
+    @db_session
+    def size(self):
+        return db.select('SELECT count(*) FROM depositkey')[0]
+
+    @db_session_seconds.time('key_pool_add')
+    @db_session
+    def add(self, count):
+        accounts = [Account.create() for _ in range(count)]
+        addresses = [acc.address for acc in accounts]
+        privkeys = [self.encrypt(acc.privateKey) for acc in accounts]
+        db.execute('INSERT INTO depositkey (address, privkey) SELECT * FROM unnest($addresses::text[], $privkeys::text[])')
+
+    # returns list of up to count (address, privkey), removed from the pool
+    @db_session_seconds.time('key_pool_claim')
+    @db_session
+    def claim(self, count):
+        cursor = db.execute('''DELETE FROM depositkey
+                               WHERE id IN (SELECT id FROM depositkey ORDER BY id LIMIT $count FOR UPDATE SKIP LOCKED)
+                               RETURNING address, privkey''')
+        return [(address, self.decrypt(privkey)) for address, privkey in cursor.fetchall()]
+
+    def fill(self):
+        size = self.size()
+        if size >= self.low:
+            return
+        logging.info(f'deposit key pool holds {size} keys, refilling to {self.high}')
+        while size < self.high:
+            count = min(key_pool_batch, self.high - size)
+            self.add(count)
+            size += count
+
+    def run(self):
+        """Keeps the pool between its low and high watermarks forever. Should be
+        called from a unique thread."""
+        while True:
+            try:
+                self.fill()
+            except Exception as e:
+                logging.error('deposit key pool refill failed', exc_info=True)
+            self.wake.wait(timeout=key_pool_check)
+            self.wake.clear()
+
+    def get_keys(self, count):
+        """Returns count (address, privkey) pairs, claimed from the pool when it is
+        enabled and not empty, otherwise generated on the spot."""
+        keys = []
+        if self.enabled():
+            try:
+                keys = self.claim(count)
+            except Exception as e:
+                logging.error('deposit key pool claim failed', exc_info=True)
+            if len(keys) < count:
+                logging.warning('deposit key pool empty, generating keys')
+            self.wake.set()
+        while len(keys) < count:
+            acc = Account.create()
+            keys.append((acc.address, acc.privateKey.hex()))
+        return keys
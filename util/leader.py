@@ -0,0 +1,84 @@
+import os
+import time
+import logging
+import psycopg2
+from database.models import db
+
+leader_lock_key = 7036152 # pg advisory lock key held by the process running the payment processing threads
+leader_retry = int(os.environ.get('LEADER_RETRY', 10)) # seconds between attempts to become leader / leader lock health checks
+
+lock_pid = None # backend pid of the connection holding the leader lock; None without leader election, 0 while the lock state is unknown
+
+
+class LeaderLockLost(Exception):
+    pass
+
+
+def connect():
+    conn = psycopg2.connect(host=os.environ['DB_HOST'], database=os.environ['DB_DATABASE'],
+                            user=os.environ['DB_USERNAME'], password=os.environ['DB_PASSWORD'])
+    conn.autocommit = True
+    return conn
+
+
+def try_lock(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s)', (leader_lock_key,))
+    return cursor.fetchone()[0]
+
+
+# returns whether this process may credit payments, checked in the caller's db_session so the check and the credits commit together
+def holds_lock():
+    if lock_pid is None:
+        return True
+    # a bigint advisory lock key is stored as classid (high 32 bits) and objid (low 32 bits), with objsubid 1
+    return bool(db.select("SELECT pid FROM pg_locks WHERE locktype = 'advisory' AND classid = 0 AND objid = $leader_lock_key "
+                          "AND objsubid = 1 AND granted AND pid = $lock_pid"))
+
+
+# returns whether the payment processing may run, False while the leader lock state is unknown
+def leading():
+    return lock_pid != 0
+
+
+def run_as_leader(start):
+    """Waits until this process holds the leader advisory lock, then calls start()
+    once and keeps holding the lock on a dedicated connection, so exactly one process
+    of a deployment runs start(). If the lock connection is lost and another process
+    took the lock over meanwhile, this process exits so the two never run together.
+    While the lock state is unknown, payment processing pauses (leading() is False)
+    and credit_payments refuses to commit (holds_lock() checks the lock in the same
+    transaction). Should be called from a unique thread."""
+    global lock_pid
+    conn = None
+    while conn is None:
+        try:
+            conn = connect()
+            if not try_lock(conn):
+                conn.close()
+                conn = None
+        except Exception as e:
+            logging.error('leader lock attempt failed', exc_info=True)
+            conn = None
+        if conn is None:
+            time.sleep(leader_retry)
+    lock_pid = conn.get_backend_pid()
+    logging.info(f'process {os.getpid()} is leader, starting payment processing')
+    start()
+    while True:
+        time.sleep(leader_retry)
+        try:
+            conn.cursor().execute('SELECT 1')
+        except Exception as e:
+            logging.warning('leader lock connection lost, pausing payment processing and reacquiring', exc_info=True)
+            lock_pid = 0
+            try:
+                conn = connect()
+                locked = try_lock(conn)
+            except Exception as e:
+                continue # db unreachable, retry while paused
+            if not locked:
+                logging.critical('leader lock taken over by another process, exiting')
+                os._exit(1)
+            lock_pid = conn.get_backend_pid()
+            logging.info('leader lock reacquired, resuming payment processing')
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import functools
+import threading
+
+metrics_dir = os.environ.get('METRICS_MULTIPROC_DIR', '') # directory in which every process of a deployment writes its metrics, so /metrics adds them up; '' serves the scraped process's own metrics only
+metrics_write_interval = int(os.environ.get('METRICS_WRITE_INTERVAL', 5)) # seconds between writes of a process's metrics to metrics_dir
+
+# upper bounds in seconds of the latency histogram buckets
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = [] # every metric of this process, in /metrics order
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+# returns the {name="value",...} part of a sample, empty without labels
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    # returns list of sample lines
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'] + self.samples()
+
+    # returns dict of the metric and its values, as written to metrics_dir
+    def state(self):
+        return {'name': self.name, 'help': self.help, 'type': self.type, 'labels': list(self.labels), 'values': self.dump()}
+
+
+# returns the sample lines of a counter or gauge with values dict of label values => value
+def value_samples(name, labels, values):
+    return [f'{name}{format_labels(labels, key)} {format_value(value)}' for key, value in sorted(values.items()) if value is not None]
+
+
+# returns the sample lines of a histogram with values dict of label values => (count per bucket plus +Inf, sum, count)
+def histogram_samples(name, labels, buckets, values):
+    lines = []
+    for key, (counts, total, count) in sorted(values.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(tuple(buckets) + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = 'le="' + format_value(bound) + '"'
+            lines.append(f'{name}_bucket{format_labels(labels, key, le)} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels, key)} {format_value(total)}')
+        lines.append(f'{name}_count{format_labels(labels, key)} {count}')
+    return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {} # label values => count
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return value_samples(self.name, self.labels, values)
+
+    def dump(self):
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Gauge whose values are read when /metrics is scraped, from a callback
+    returning a dict of label values tuple => value, so nothing is recorded
+    on the hot paths."""
+    type = 'gauge'
+
+    def __init__(self, name, help, callback, labels=()):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def samples(self):
+        return value_samples(self.name, self.labels, self.callback())
+
+    def dump(self):
+        return [[list(key), value] for key, value in self.callback().items() if value is not None]
+
+
+class Timer:
+    """Observes the seconds spent in a with block, or in a decorated function."""
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with Timer(self.histogram, self.label_values):
+                return func(*args, **kwargs)
+        return timed
+
+
+class Histogram(Metric):
+    """Cumulative histogram of observed values, kept as per bucket counts so an
+    observation is a bisect and three additions under a lock."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {} # label values => [count per bucket plus +Inf, sum, count]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        return histogram_samples(self.name, self.labels, self.buckets, values)
+
+    def dump(self):
+        with self.lock:
+            return [[list(key), list(counts), total, count] for key, (counts, total, count) in self.values.items()]
+
+    def state(self):
+        return dict(super().state(), buckets=list(self.buckets))
+
+
+def write(exiting=False):
+    """Writes the metrics of this process to metrics_dir/<pid>.json. The file of an
+    exited process is kept, without its gauges, so the counters of the deployment
+    never go down."""
+    state = {'pid': os.getpid(), 'time': time.time(), 'exiting': exiting,
+             'metrics': [metric.state() for metric in registry if not (exiting and metric.type == 'gauge')]}
+    path = os.path.join(metrics_dir, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(path + '.tmp', path) # scrapes never read a half written file
+
+
+def run_writer():
+    """Writes the metrics of this process to metrics_dir every metrics_write_interval
+    seconds, and once more at exit. Should be called from a unique thread."""
+    atexit.register(write, True)
+    while True:
+        try:
+            write()
+        except Exception:
+            logging.error('writing metrics failed', exc_info=True)
+        time.sleep(metrics_write_interval)
+
+
+# returns the metrics written to metrics_dir by every process, added up: counters and histograms are summed,
+# gauges of live processes get a pid label
+def merge():
+    merged = {} # name => state with values dict
+    for file_name in sorted(os.listdir(metrics_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(metrics_dir, file_name)) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            continue # removed, or written by an older version
+        live = not state['exiting'] and time.time() - state['time'] < 3 * metrics_write_interval + 10
+        for metric in state['metrics']:
+            if metric['type'] == 'gauge' and not live:
+                continue
+            entry = merged.setdefault(metric['name'], dict(metric, values={}))
+            values = entry['values']
+            for value in metric['values']:
+                key = tuple(value[0])
+                if metric['type'] == 'gauge':
+                    values[key + (state['pid'],)] = value[1]
+                elif metric['type'] == 'counter':
+                    values[key] = values.get(key, 0) + value[1]
+                else:
+                    counts, total, count = values.get(key, ([0] * len(value[1]), 0.0, 0))
+                    values[key] = ([a + b for a, b in zip(counts, value[1])], total + value[2], count + value[3])
+    return merged
+
+
+# returns the metrics in the Prometheus text exposition format, of this process only, or of all processes with metrics_dir
+def render():
+    lines = []
+    if not metrics_dir:
+        for metric in registry:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+    write()
+    for name, metric in merge().items():
+        lines.extend([f'# HELP {name} {metric["help"]}', f'# TYPE {name} {metric["type"]}'])
+        if metric['type'] == 'histogram':
+            lines.extend(histogram_samples(name, metric['labels'], metric['buckets'], metric['values']))
+        else:
+            labels = metric['labels'] + ['pid'] if metric['type'] == 'gauge' else metric['labels']
+            lines.extend(value_samples(name, labels, metric['values']))
+    return '\n'.join(lines) + '\n'
+
+
+rpc_request_seconds = Histogram('rpc_request_seconds', 'Latency of JSON-RPC requests to the chain nodes, batch for batch requests',
+                                ['chain', 'method'])
+rpc_calls_total = Counter('rpc_calls_total', 'JSON-RPC calls sent to the chain nodes, calls inside batch requests included',
+                          ['chain', 'method'])
+cycle_seconds = Histogram('payment_cycle_seconds', 'Duration of a payment processing cycle (handle_evm_event)', ['chain'])
+db_session_seconds = Histogram('db_session_seconds', 'Time spent in a db_session', ['session'])
@@ -0,0 +1,31 @@
+import os
+import json
+
+multicall_batch_size = int(os.environ.get('MULTICALL_BATCH_SIZE', 500)) # max number of balance reads aggregated into a single eth_call
+
+with open("util/multicall3_abi.json", "r") as file:
+    multicall_abi = json.load(file)
+
+
+def aggregate_balances(multicall, token, addresses, block_identifier=None, chunk_size=None):
+    """Reads the native balance (Multicall3 getEthBalance) and the token balance
+    (balanceOf) of every address through Multicall3 aggregate3, with every chunk
+    pinned to the same block. Returns (block_number, native, token) where native and
+    token are dicts of addr => raw balance."""
+    chunk_size = chunk_size or multicall_batch_size
+    if block_identifier is None:
+        block_identifier = multicall.web3.eth.block_number
+    addresses = list(addresses)
+    native = {}
+    balances = {}
+    for start in range(0, len(addresses), chunk_size):
+        chunk = addresses[start:start + chunk_size]
+        calls = []
+        for address in chunk:
+            calls.append((multicall.address, False, multicall.encodeABI(fn_name='getEthBalance', args=[address])))
+            calls.append((token.address, False, token.encodeABI(fn_name='balanceOf', args=[address])))
+        results = multicall.functions.aggregate3(calls).call(block_identifier=block_identifier)
+        for i, address in enumerate(chunk):
+            native[address] = int.from_bytes(results[2*i][1], 'big')
+            balances[address] = int.from_bytes(results[2*i + 1][1], 'big')
+    return block_identifier, native, balances
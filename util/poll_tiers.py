@@ -0,0 +1,90 @@
+import os
+import time
+
+hot_window = int(os.environ.get('POLL_HOT_WINDOW', 3600)) # seconds after a balance change during which an address is polled every cycle
+warm_window = int(os.environ.get('POLL_WARM_WINDOW', 7*24*3600)) # seconds after a quote or balance change during which an address is warm
+warm_interval = int(os.environ.get('POLL_WARM_INTERVAL', 300)) # seconds between polls of warm addresses
+cold_interval = int(os.environ.get('POLL_COLD_INTERVAL', 3600)) # seconds between polls of dormant addresses
+
+tier_intervals = {
+    'hot': 0, # polled every cycle
+    'warm': warm_interval,
+    'cold': cold_interval
+}
+
+
+class AddressState:
+    __slots__ = ('pending', 'active', 'last_quote', 'last_change', 'last_polled', 'balances')
+
+    def __init__(self):
+        self.pending = False
+        self.active = False
+        self.last_quote = 0
+        self.last_change = 0
+        self.last_polled = None
+        self.balances = {} # evm_coin_block_token_ => last seen balance
+
+
+class PollTiers:
+    """Sorts the deposit addresses of a chain into hot/warm/cold tiers and picks the
+    addresses due for a balance poll each cycle:
+    - hot: pending quote or balance changed within hot_window, polled every cycle
+    - warm: active project, or quote/balance change within warm_window, polled every warm_interval
+    - cold: everything else, polled every cold_interval"""
+
+    def __init__(self):
+        self.states = {}
+
+    # rows is an iterable of (address, pending, project active, quote_start_time as unix time)
+    def update(self, rows):
+        states = {}
+        for address, pending, active, last_quote in rows:
+            state = self.states.get(address) or AddressState()
+            state.pending = bool(pending)
+            state.active = bool(active)
+            state.last_quote = last_quote
+            states[address] = state
+        self.states = states
+
+    def tier(self, state, now):
+        if state.pending or now - state.last_change < hot_window:
+            return 'hot'
+        if state.active or now - max(state.last_quote, state.last_change) < warm_window:
+            return 'warm'
+        return 'cold'
+
+    # returns the addresses due for a balance poll; addresses never polled are always due
+    def due(self, now=None):
+        now = now or time.time()
+        return [address for address, state in self.states.items()
+                if state.last_polled is None or now - state.last_polled >= tier_intervals[self.tier(state, now)]]
+
+    def mark_polled(self, addresses, now=None):
+        now = now or time.time()
+        for address in addresses:
+            if address in self.states:
+                self.states[address].last_polled = now
+
+    # marks addresses never polled as polled at polled_time, e.g. at the last processed block before a restart
+    def resume(self, polled_time):
+        for state in self.states.values():
+            if state.last_polled is None:
+                state.last_polled = polled_time
+
+    # records a polled balance, moving the address to the hot tier if it changed since the last poll
+    def observe(self, address, evm_coin_block_token_, balance, now=None):
+        state = self.states.get(address)
+        if state is None:
+            return
+        previous = state.balances.get(evm_coin_block_token_)
+        if previous is not None and previous != balance:
+            state.last_change = now or time.time()
+        state.balances[evm_coin_block_token_] = balance
+
+    # returns dict of tier => number of addresses
+    def counts(self, now=None):
+        now = now or time.time()
+        counts = {tier: 0 for tier in tier_intervals}
+        for state in self.states.values():
+            counts[self.tier(state, now)] += 1
+        return counts
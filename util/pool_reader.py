@@ -0,0 +1,169 @@
+import os
+import json
+import logging
+import threading
+from eth_abi import decode_abi
+from web3 import Web3
+from util.rpc_batch import batch_request, rpc_batch_size
+from util.reserve_tracker import ReserveTracker, track_pool_reserves
+
+pool_metadata_file = os.environ.get('POOL_METADATA_FILE', '') # json file persisting pool token metadata across restarts; '' keeps it in memory only
+
+with open("util/pool.json") as poolFile:
+    poolABI = json.load(poolFile)
+with open("util/ERC20.json") as erc20File:
+    ERC20ABI = json.load(erc20File)
+with open("util/uniswap_factory_abi.json") as factoryFile:
+    factoryABI = json.load(factoryFile)
+
+metadata_file_lock = threading.Lock()
+
+
+class PoolMetadata:
+    """Token addresses, token0 symbol and decimals of a pool; these never change
+    after the pool is deployed."""
+    __slots__ = ('token0', 'token1', 'symbol0', 'decimals0', 'decimals1')
+
+    def __init__(self, token0, token1, symbol0, decimals0, decimals1):
+        self.token0 = token0
+        self.token1 = token1
+        self.symbol0 = symbol0
+        self.decimals0 = decimals0
+        self.decimals1 = decimals1
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# returns the price of one quote_symbol token in the other token of a pool with reserves reserve0, reserve1
+def pool_price(meta, quote_symbol, reserve0, reserve1):
+    amount0 = reserve0 / 10 ** meta.decimals0
+    amount1 = reserve1 / 10 ** meta.decimals1
+    return amount1 / amount0 if meta.symbol0 == quote_symbol else amount0 / amount1
+
+
+def load_metadata_file(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+class PoolReader:
+    """Reads the prices of a fixed set of uniswap v2 style pools. The metadata of
+    every pool is fetched once (or loaded from metadata_file) and cached, so a price
+    read only costs one getReserves call per pool, and all pools are read with a
+    single JSON-RPC batch request on http(s) nodes. pools maps name => pool address.
+    With track_reserves the reserves are followed from the pools' Sync events by a
+    ReserveTracker instead, which can also average the prices over time."""
+
+    def __init__(self, w3, pools, metadata_file=None, track_reserves=None):
+        self.w3 = w3
+        self.pools = {name: Web3.toChecksumAddress(address) for name, address in pools.items()}
+        self.contracts = {name: w3.eth.contract(address=address, abi=poolABI) for name, address in self.pools.items()}
+        self.metadata_file = pool_metadata_file if metadata_file is None else metadata_file
+        self.metadata = None # name => PoolMetadata
+        track_reserves = track_pool_reserves if track_reserves is None else track_reserves
+        self.tracker = ReserveTracker(w3, self.pools, self.get_reserves) if track_reserves else None
+
+    def fetch_metadata(self, address):
+        pool = self.w3.eth.contract(address=address, abi=poolABI)
+        token0 = pool.functions.token0().call()
+        token1 = pool.functions.token1().call()
+        erc20_0 = self.w3.eth.contract(address=token0, abi=ERC20ABI)
+        erc20_1 = self.w3.eth.contract(address=token1, abi=ERC20ABI)
+        return PoolMetadata(token0, token1, erc20_0.functions.symbol().call(), erc20_0.functions.decimals().call(),
+                            erc20_1.functions.decimals().call())
+
+    def load_metadata(self):
+        if self.metadata is not None:
+            return self.metadata
+        with metadata_file_lock:
+            stored = load_metadata_file(self.metadata_file) if self.metadata_file else {}
+            metadata = {}
+            for name, address in self.pools.items():
+                if address.lower() in stored:
+                    metadata[name] = PoolMetadata(**stored[address.lower()])
+                else:
+                    logging.info(f'fetching metadata of pool {name} ({address})')
+                    metadata[name] = self.fetch_metadata(address)
+                    stored[address.lower()] = metadata[name].to_dict()
+            if self.metadata_file:
+                with open(self.metadata_file, 'w') as file:
+                    json.dump(stored, file, indent=1)
+        self.metadata = metadata
+        return metadata
+
+    # returns dict of name => (reserve0, reserve1)
+    def get_reserves(self, block_identifier='latest'):
+        names = list(self.pools)
+        if rpc_batch_size > 0 and isinstance(self.w3.provider, Web3.HTTPProvider):
+            block = hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+            data = self.contracts[names[0]].encodeABI(fn_name='getReserves')
+            results = batch_request(self.w3.provider.endpoint_uri,
+                                    [('eth_call', [{'to': self.pools[name], 'data': data}, block]) for name in names])
+            reserves = [decode_abi(['uint112', 'uint112', 'uint32'], Web3.toBytes(hexstr=result)) for result in results]
+        else:
+            reserves = [self.contracts[name].functions.getReserves().call(block_identifier=block_identifier) for name in names]
+        return {name: (reserve[0], reserve[1]) for name, reserve in zip(names, reserves)}
+
+    # returns dict of name => price of one quote_symbol token in the pool's other token,
+    # averaged over the tracker's window when the reserves are tracked and the window is set
+    def get_prices(self, quote_symbol, block_identifier='latest'):
+        metadata = self.load_metadata()
+        tracked = self.tracker is not None and block_identifier == 'latest'
+        reserves = self.tracker.update() if tracked else self.get_reserves(block_identifier)
+        prices = {}
+        for name, (reserve0, reserve1) in reserves.items():
+            if tracked and self.tracker.window > 0:
+                prices[name] = self.tracker.twap(name, lambda reserve0, reserve1: pool_price(metadata[name], quote_symbol, reserve0, reserve1))
+            else:
+                prices[name] = pool_price(metadata[name], quote_symbol, reserve0, reserve1)
+        return prices
+
+
+# returns the output amount of a uniswap v2 swap of amount_in base units, with the 0.3% fee, as the router's getAmountOut
+def get_amount_out(amount_in, reserve_in, reserve_out):
+    amount_in_with_fee = amount_in * 997
+    return amount_in_with_fee * reserve_out // (reserve_in * 1000 + amount_in_with_fee)
+
+
+class RouterPairs:
+    """Quotes a uniswap v2 router's getAmountsOut for single hop paths from the
+    reserves of the pairs behind them, without an eth_call per quote. The pairs are
+    resolved once with the router's factory().getPair() and their reserves followed
+    from their Sync events by the ReserveTracker of a PoolReader, averaged over its
+    window if set. paths is a list of (token in, token out) addresses."""
+
+    def __init__(self, w3, router, paths):
+        self.w3 = w3
+        self.router = router
+        self.paths = {f'{token_in}/{token_out}': (token_in, token_out) for token_in, token_out in paths}
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def load_reader(self):
+        with self.lock:
+            if self.reader is None:
+                factory = self.w3.eth.contract(address=self.router.functions.factory().call(), abi=factoryABI)
+                pairs = {}
+                for name, (token_in, token_out) in self.paths.items():
+                    pairs[name] = factory.functions.getPair(token_in, token_out).call()
+                    if int(pairs[name], 16) == 0:
+                        raise ValueError(f'no uniswap pair for {name}')
+                logging.info(f'tracking uniswap pairs {pairs}')
+                self.reader = PoolReader(self.w3, pairs, track_reserves=True)
+            return self.reader
+
+    # returns the amount of token_out, in base units, for amount_in base units of token_in
+    def get_amount_out(self, token_in, token_out, amount_in):
+        reader = self.load_reader()
+        name = f'{token_in}/{token_out}'
+        reserves = reader.tracker.update()[name]
+        token0_in = reader.load_metadata()[name].token0.lower() == token_in.lower()
+
+        def amount_out(reserve0, reserve1):
+            return get_amount_out(amount_in, reserve0, reserve1) if token0_in else get_amount_out(amount_in, reserve1, reserve0)
+
+        return reader.tracker.twap(name, amount_out) if reader.tracker.window > 0 else amount_out(*reserves)
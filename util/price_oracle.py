@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from util.rpc_budget import set_priority
+
+price_refresh_interval = int(os.environ.get('PRICE_REFRESH_INTERVAL', 60)) # seconds between background price refreshes
+price_source_timeout = float(os.environ.get('PRICE_SOURCE_TIMEOUT', 10)) # max seconds a refresh waits for a single price source
+price_max_staleness = int(os.environ.get('PRICE_MAX_STALENESS', 300)) # prices older than this many seconds are not quoted
+
+
+class PriceSnapshot:
+    """Immutable set of usd prices, keyed by coin name, with the time each price
+    was fetched. A refresh builds a new snapshot instead of changing this one, so
+    a request reading a snapshot always sees one consistent set of prices."""
+    __slots__ = ('prices', 'times')
+
+    def __init__(self, prices, times):
+        object.__setattr__(self, 'prices', prices)
+        object.__setattr__(self, 'times', times)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PriceSnapshot is immutable')
+
+    # returns seconds since the price of coin_name was fetched, None if it never was
+    def age(self, coin_name, now=None):
+        if coin_name not in self.times:
+            return None
+        return (now or time.time()) - self.times[coin_name]
+
+    # returns usd price of coin_name, None if unknown or older than max_staleness
+    def price(self, coin_name, max_staleness=None, now=None):
+        age = self.age(coin_name, now)
+        if age is None or age > (price_max_staleness if max_staleness is None else max_staleness):
+            return None
+        return self.prices[coin_name]
+
+    # returns usd_amount converted to coin_name, None if there is no fresh price
+    def amount(self, coin_name, usd_amount, max_staleness=None, now=None):
+        price = self.price(coin_name, max_staleness, now)
+        if not price:
+            return None
+        return round(usd_amount / price, 10)
+
+
+class PriceOracle:
+    """Refreshes the prices of all sources in parallel in a background thread and
+    publishes them as a PriceSnapshot; request threads only read the snapshot and
+    never wait on an rpc node. sources maps coin name => function returning the usd
+    price (or None when the coin's chain is not configured). A source that fails or
+    takes longer than price_source_timeout keeps its previous price and fetch time,
+    and is not queried again until its previous call returned.
+
+    With several server processes, only one needs to query the sources: it sets
+    publish, a function called with every refreshed snapshot, and the others set
+    follow, a function returning the snapshot last published, which a refresh
+    then loads instead of querying the sources."""
+
+    def __init__(self, sources, timeout=None):
+        self.sources = sources
+        self.timeout = timeout or price_source_timeout
+        self.current = PriceSnapshot({}, {})
+        self.refreshed = False
+        self.lock = threading.Lock()
+        # price lookups yield the rpc budget of their chain to deposit detection and api requests
+        self.executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='price', initializer=set_priority, initargs=('prices',))
+        self.running = {} # coin name => future of a source call still in flight
+        self.publish = None
+        self.follow = None
+
+    def snapshot(self):
+        # the first read before the background thread refreshed does a single blocking refresh
+        if not self.refreshed:
+            with self.lock:
+                if not self.refreshed:
+                    self.refresh()
+        return self.current
+
+    def refresh(self):
+        if self.follow is not None:
+            self.current = self.follow()
+            self.refreshed = True
+            return self.current
+        futures = {}
+        for coin_name, source in self.sources.items():
+            if coin_name in self.running and not self.running[coin_name].done():
+                logging.warning(f'{coin_name} price source still busy, keeping previous price')
+                continue
+            futures[coin_name] = self.running[coin_name] = self.executor.submit(source)
+        wait(futures.values(), timeout=self.timeout)
+
+        now = time.time()
+        prices = dict(self.current.prices)
+        times = dict(self.current.times)
+        for coin_name, future in futures.items():
+            if not future.done():
+                logging.warning(f'{coin_name} price lookup timed out after {self.timeout}s')
+                continue
+            try:
+                price = future.result()
+            except Exception as e:
+                logging.warning(f'{coin_name} price lookup failed with error:', exc_info=True)
+                continue
+            if price is not None:
+                prices[coin_name] = price
+                times[coin_name] = now
+        self.current = PriceSnapshot(prices, times)
+        self.refreshed = True
+        if self.publish is not None:
+            try:
+                self.publish(self.current)
+            except Exception as e:
+                logging.error('publishing prices failed', exc_info=True)
+        return self.current
+
+    def run(self):
+        """Refreshes the prices forever. Should be called from a unique thread."""
+        while True:
+            start = time.time()
+            try:
+                with self.lock:
+                    self.refresh()
+            except Exception as e:
+                logging.error('price refresh failed', exc_info=True)
+            time.sleep(max(price_refresh_interval - (time.time() - start), 0))
@@ -0,0 +1,100 @@
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from web3 import Web3
+from web3.middleware import geth_poa_middleware
+from util.metrics import rpc_request_seconds, rpc_calls_total
+from util.rpc_budget import coalesced_methods, get_coalescer, spend
+
+rpc_pool_size = int(os.environ.get('RPC_POOL_SIZE', 10)) # max keep-alive connections per node
+rpc_timeout = int(os.environ.get('RPC_TIMEOUT', 30)) # seconds to wait for a single rpc response
+rpc_retries = int(os.environ.get('RPC_RETRIES', 3)) # retries of an rpc request after a connection error or 429/5xx reply
+
+url_ext = {'avax': '/ext/bc/C/rpc'}
+
+lock = threading.Lock()
+web3s = {} # evm => Web3, shared by the payment loops and the price readers
+sessions = {} # endpoint uri => requests.Session
+chains = {} # endpoint uri => evm, to label the metrics of batch requests
+
+
+def endpoint_uri(evm):
+    host_type = os.environ.get(f'{evm.upper()}_HOST_TYPE', '')
+    host = os.environ.get(f'{evm.upper()}_HOST', '')
+    port = os.environ.get(f'{evm.upper()}_PORT', '')
+    return f'{host_type}://{host}:{port}{url_ext.get(evm, "")}'
+
+
+# returns the keep-alive session of an http(s) endpoint, with a connection pool of rpc_pool_size and retries
+def get_session(uri):
+    with lock:
+        if uri not in sessions:
+            retry = Retry(total=rpc_retries, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                          allowed_methods=None) # JSON-RPC reads are POSTs
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=rpc_pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[uri] = session
+        return sessions[uri]
+
+
+# returns web3 middleware recording the latency and count of every request to the node of evm
+def metrics_middleware(evm):
+    def middleware(make_request, w3):
+        def record(method, params):
+            start = time.perf_counter()
+            try:
+                return make_request(method, params)
+            finally:
+                rpc_request_seconds.observe(time.perf_counter() - start, evm, method)
+                rpc_calls_total.inc(evm, method)
+        return record
+    return middleware
+
+
+# returns web3 middleware which answers identical in-flight read calls with one request to the node of evm,
+# and makes every request wait for the rpc budget of evm
+def budget_middleware(evm):
+    coalescer = get_coalescer(evm)
+
+    def middleware(make_request, w3):
+        def send(method, params):
+            spend(evm)
+            return make_request(method, params)
+
+        def request(method, params):
+            if method in coalesced_methods:
+                return coalescer.request(method, params, send)
+            return send(method, params)
+        return request
+    return middleware
+
+
+def get_web3(evm):
+    """Returns the shared Web3 of an evm chain ('eth', 'avax' or 'nevm'), built from
+    the <EVM>_HOST/_PORT/_HOST_TYPE variables on first use, or None when the chain
+    is not configured. Every module talking to a node uses this instance, so all
+    requests to a node go through one pooled keep-alive session (http) or one
+    connection (ws)."""
+    with lock:
+        if evm in web3s:
+            return web3s[evm]
+    host_type = os.environ.get(f'{evm.upper()}_HOST_TYPE', '')
+    if os.environ.get(f'{evm.upper()}_HOST', '') == '' or host_type not in ['http', 'https', 'ws', 'wss']:
+        w3 = None
+    elif host_type in ['http', 'https']:
+        uri = endpoint_uri(evm)
+        w3 = Web3(Web3.HTTPProvider(uri, request_kwargs={'timeout': rpc_timeout}, session=get_session(uri)))
+    else:
+        w3 = Web3(Web3.WebsocketProvider(endpoint_uri(evm), websocket_timeout=rpc_timeout))
+    if w3 is not None:
+        w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        w3.middleware_onion.inject(budget_middleware(evm), name='budget', layer=0)
+        w3.middleware_onion.inject(metrics_middleware(evm), name='metrics', layer=0) # innermost, times the request itself
+        chains[endpoint_uri(evm)] = evm
+    with lock:
+        return web3s.setdefault(evm, w3)
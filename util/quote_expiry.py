@@ -0,0 +1,75 @@
+import os
+import heapq
+import logging
+import datetime
+import threading
+from database.models import db, db_session
+from util import quote_valid_hours
+from util.metrics import db_session_seconds
+
+quote_expiry_max_sleep = int(os.environ.get('QUOTE_EXPIRY_MAX_SLEEP', 300)) # max seconds between expiry runs, also resyncs the heap from the db
+
+
+class QuoteExpiry:
+    """Sets payment.pending = False for every quote older than quote_valid_hours with
+    a single set-based UPDATE. Upcoming expiry times are kept in a min-heap so the
+    job wakes exactly when the next quote expires; create/extend calls add new
+    quotes with schedule(), and the heap is resynced from the db every
+    quote_expiry_max_sleep seconds to pick up quotes made by other processes."""
+
+    def __init__(self):
+        self.heap = [] # (expiry time, payment id)
+        self.condition = threading.Condition()
+        self.running = False # only the process running the job keeps a heap, the others leave their quotes to its resync
+
+    def schedule(self, payment_id, quote_start_time):
+        if not self.running:
+            return
+        with self.condition:
+            heapq.heappush(self.heap, (quote_start_time + datetime.timedelta(hours=quote_valid_hours), payment_id))
+            self.condition.notify()
+
+    @db_session_seconds.time('quote_expiry_load')
+    @db_session
+    def load(self):
+        rows = db.select('SELECT id, quote_start_time FROM payment WHERE pending = true')
+        with self.condition:
+            self.heap = [(quote_start_time + datetime.timedelta(hours=quote_valid_hours), payment_id) for payment_id, quote_start_time in rows]
+            heapq.heapify(self.heap)
+
+    # returns list of (payment id, project name) of the quotes that were expired
+    @db_session_seconds.time('quote_expiry')
+    @db_session
+    def expire(self):
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=quote_valid_hours)
+        cursor = db.execute('UPDATE payment SET pending = false WHERE pending = true AND quote_start_time <= $cutoff RETURNING id, project')
+        expired = cursor.fetchall()
+        for payment_id, project in expired:
+            logging.info(f'setting payment.pending = False for project: {project} due to quote time expired.')
+        return expired
+
+    def run(self):
+        """Runs the expiry job forever. Should be called from a unique thread."""
+        self.running = True
+        last_load = None
+        while True:
+            try:
+                due = False
+                if last_load is None or (datetime.datetime.now() - last_load).total_seconds() >= quote_expiry_max_sleep:
+                    self.load()
+                    last_load = datetime.datetime.now()
+                    due = True
+                with self.condition:
+                    now = datetime.datetime.now()
+                    while self.heap and self.heap[0][0] <= now:
+                        heapq.heappop(self.heap)
+                        due = True
+                if due:
+                    self.expire()
+            except Exception as e:
+                logging.error('quote expiry failed', exc_info=True)
+            with self.condition:
+                timeout = quote_expiry_max_sleep
+                if self.heap:
+                    timeout = min(timeout, (self.heap[0][0] - datetime.datetime.now()).total_seconds())
+                self.condition.wait(timeout=max(timeout, 0))
@@ -0,0 +1,82 @@
+import json
+import time
+from util import price_oracle, min_payment_amount_tier1, min_payment_amount_tier2, min_payment_amount_xquery, \
+                 discount_ablock, discount_aablock, discount_sysblock
+from util.price_oracle import price_max_staleness
+
+# min payment amount in usd of each tier; a tier with a negative amount is not offered by this node
+tier_usd = {'tier1': min_payment_amount_tier1, 'tier2': min_payment_amount_tier2, 'xquery': min_payment_amount_xquery}
+discounts = {'ablock': discount_ablock, 'aablock': discount_aablock, 'sysblock': discount_sysblock}
+# payment fields of a create/extend response that come from the quote
+fragment_fields = ['eth', 'ablock', 'avax', 'aablock', 'sys', 'sysblock', 'usd', 'ablock_usd', 'aablock_usd', 'sysblock_usd']
+
+
+class QuoteTable:
+    """Min payment amounts of every coin and tier for one price snapshot, computed
+    once and shared by all requests until the snapshot changes or one of its prices
+    gets too old. Holds the min amounts of each tier ('free' for auto activated
+    projects), the json fragment of each tier's amounts in a create/extend response,
+    and the serialized GET /quote response."""
+
+    def __init__(self, snapshot, coin_names, hosts, now=None):
+        now = now or time.time()
+        self.snapshot = snapshot
+        self.amounts = {}
+        for evm in coin_names:
+            for native_block_ in [True, False]:
+                coin_name = coin_names[evm][native_block_]
+                discount = discounts[coin_name] if not native_block_ else 1
+                for tier, usd in tier_usd.items():
+                    self.amounts[f'{tier}_min_amount_{coin_name}'] = snapshot.amount(coin_name, usd*discount, now=now) if hosts[evm] != '' else None
+
+        self.min_amounts = {'free': {'usd': 0}}
+        for tier, usd in tier_usd.items():
+            self.min_amounts[tier] = {'usd': usd}
+        for evm in coin_names:
+            for native_block_ in [True, False]:
+                coin_name = coin_names[evm][native_block_]
+                discount = discounts[coin_name] if not native_block_ else 1
+                self.min_amounts['free'][coin_name] = 0
+                self.min_amounts['free'][f'{coin_name}_usd'] = 0
+                for tier, usd in tier_usd.items():
+                    self.min_amounts[tier][coin_name] = self.amounts[f'{tier}_min_amount_{coin_name}']
+                    self.min_amounts[tier][f'{coin_name}_usd'] = usd*discount
+
+        self.fragments = {}
+        for tier, min_amount in self.min_amounts.items():
+            self.fragments[tier] = json.dumps({f'min_amount_{field}': min_amount[field] for field in fragment_fields})[1:-1]
+
+        coins = [coin_name for evm in coin_names for coin_name in coin_names[evm].values()]
+        self.body = json.dumps({
+            'result': {tier: self.min_amounts[tier] for tier, usd in tier_usd.items() if usd >= 0},
+            'price_time': {coin_name: snapshot.times.get(coin_name) for coin_name in coins},
+            'error': 0
+        })
+        # the table changes once the oldest price it quotes becomes too old to quote
+        quoted = [snapshot.times[coin_name] for coin_name in coins if snapshot.price(coin_name, now=now) is not None]
+        self.valid_until = min(quoted) + price_max_staleness if quoted else float('inf')
+
+    def available(self):
+        return len(self.amounts) - list(self.amounts.values()).count(None) >= 1
+
+    # returns serialized create/extend response of the project specific fields plus the tier's amounts
+    def response(self, tier, fields):
+        return '{"result": {' + json.dumps(fields)[1:-1] + ', ' + self.fragments[tier] + '}}'
+
+
+class QuoteCache:
+    """Hands out the QuoteTable of the current price snapshot, rebuilding it only
+    when the price oracle published a new snapshot or a quoted price went stale."""
+
+    def __init__(self, coin_names, hosts):
+        self.coin_names = coin_names
+        self.hosts = hosts
+        self.current = None
+
+    def table(self):
+        snapshot = price_oracle.snapshot()
+        now = time.time()
+        table = self.current
+        if table is None or table.snapshot is not snapshot or now > table.valid_until:
+            table = self.current = QuoteTable(snapshot, self.coin_names, self.hosts, now)
+        return table
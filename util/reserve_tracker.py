@@ -0,0 +1,117 @@
+import os
+import logging
+import threading
+from web3 import Web3
+from util.deposit_scanner import log_scan_batch_blocks
+from util.rpc_batch import batch_request, rpc_batch_size
+
+track_pool_reserves = os.environ.get('TRACK_POOL_RESERVES', 'false').lower() == 'true' # follow the Sync events of the price pools instead of reading getReserves on every price refresh
+price_twap_window = int(os.environ.get('PRICE_TWAP_WINDOW', 0)) # seconds over which pool prices are time-weighted averaged; 0 quotes the spot price
+
+sync_topic = Web3.keccak(text='Sync(uint112,uint112)').hex()
+
+
+class ReserveTracker:
+    """Keeps the current reserves of a fixed set of uniswap v2 style pools in memory
+    by following their Sync events from a block cursor. The reserves are read once
+    with read_reserves(block_number) (a function returning dict of name => (reserve0,
+    reserve1)), after that an update costs one eth_getBlockByNumber while the chain
+    head did not move, and otherwise two more calls, eth_getLogs and the cursor block
+    hash check, for all pools together. The reserves are read again if the cursor
+    block was reorged away.
+
+    With a window, every reserve change is kept for window seconds, for twap(). Sync
+    logs carry no time, so the blocks holding them are fetched for their timestamps,
+    in one JSON-RPC batch request on http(s) nodes."""
+
+    def __init__(self, w3, pools, read_reserves, window=None):
+        self.w3 = w3
+        self.pools = pools # name => checksum address
+        self.names = {address.lower(): name for name, address in pools.items()}
+        self.read_reserves = read_reserves
+        self.window = price_twap_window if window is None else window
+        self.reserves = None # name => (reserve0, reserve1) at the cursor block
+        self.history = {} # name => list of (timestamp, reserve0, reserve1), oldest first
+        self.block_number = None
+        self.block_hash = None
+        self.timestamp = None
+        self.lock = threading.Lock()
+
+    def seed(self, head):
+        self.reserves = self.read_reserves(head['number'])
+        self.history = {name: [(head['timestamp'], reserve0, reserve1)] for name, (reserve0, reserve1) in self.reserves.items()}
+        self.move_cursor(head)
+
+    def move_cursor(self, head):
+        self.block_number = head['number']
+        self.block_hash = head['hash']
+        self.timestamp = head['timestamp']
+
+    # drops the reserve changes which ended before the window, keeping the one in effect at its start
+    def trim(self):
+        start = self.timestamp - self.window
+        for points in self.history.values():
+            keep = 0
+            while keep + 1 < len(points) and points[keep + 1][0] <= start:
+                keep += 1
+            del points[:keep]
+
+    # returns dict of block number => timestamp of the blocks numbers
+    def get_timestamps(self, numbers):
+        numbers = sorted(numbers)
+        endpoint_uri = getattr(self.w3.provider, 'endpoint_uri', None)
+        if rpc_batch_size > 0 and endpoint_uri is not None and str(endpoint_uri).startswith('http'):
+            blocks = batch_request(endpoint_uri, [('eth_getBlockByNumber', [hex(number), False]) for number in numbers])
+            return {number: int(block['timestamp'], 16) for number, block in zip(numbers, blocks)}
+        return {number: self.w3.eth.get_block(number)['timestamp'] for number in numbers}
+
+    # returns list of the Sync logs of the pools in blocks [from_block, to_block], in chain order
+    def get_sync_logs(self, from_block, to_block):
+        logs = []
+        for start in range(from_block, to_block + 1, log_scan_batch_blocks):
+            end = min(start + log_scan_batch_blocks - 1, to_block)
+            logs.extend(self.w3.eth.get_logs({'fromBlock': start, 'toBlock': end, 'address': list(self.pools.values()),
+                                              'topics': [sync_topic]}))
+        return sorted(logs, key=lambda log: (log['blockNumber'], log['logIndex']))
+
+    def update(self):
+        """Applies the Sync events since the cursor up to the chain head. Returns dict
+        of name => (reserve0, reserve1) at the head."""
+        with self.lock:
+            head = self.w3.eth.get_block('latest')
+            if self.reserves is None:
+                self.seed(head)
+            elif head['number'] != self.block_number or head['hash'] != self.block_hash:
+                if head['number'] <= self.block_number or self.w3.eth.get_block(self.block_number)['hash'] != self.block_hash:
+                    logging.warning(f'pool reserves cursor block {self.block_number} was reorged away, reading the reserves again')
+                    self.seed(head)
+                else:
+                    logs = self.get_sync_logs(self.block_number + 1, head['number'])
+                    timestamps = self.get_timestamps({log['blockNumber'] for log in logs}) if self.window > 0 and logs else {}
+                    for log in logs:
+                        name = self.names[log['address'].lower()]
+                        data = Web3.toBytes(hexstr=log['data']) if isinstance(log['data'], str) else bytes(log['data'])
+                        reserves = (int.from_bytes(data[:32], 'big'), int.from_bytes(data[32:64], 'big'))
+                        self.reserves[name] = reserves
+                        self.history[name].append((timestamps.get(log['blockNumber'], head['timestamp']), *reserves))
+                    self.move_cursor(head)
+            self.trim()
+            return dict(self.reserves)
+
+    def twap(self, name, price):
+        """Returns the time-weighted average over the last window seconds, up to the
+        cursor block, of price(reserve0, reserve1) of pool name. Averages over the
+        time since the first update while that is shorter than the window."""
+        with self.lock:
+            points = list(self.history[name])
+            now = self.timestamp
+        start = max(now - self.window, points[0][0])
+        if now <= start:
+            return price(*points[-1][1:])
+        total = 0
+        for i, (timestamp, reserve0, reserve1) in enumerate(points):
+            end = points[i + 1][0] if i + 1 < len(points) else now
+            duration = end - max(timestamp, start)
+            if duration > 0:
+                total += price(reserve0, reserve1) * duration
+        return total / (now - start)
@@ -0,0 +1,48 @@
+import os
+import json
+import itertools
+from collections import Counter
+from util.providers import get_session, chains
+from util.metrics import rpc_request_seconds, rpc_calls_total
+from util.rpc_budget import spend
+
+rpc_batch_size = int(os.environ.get('RPC_BATCH_SIZE', 100)) # max number of calls sent per JSON-RPC batch request; 0 disables batching
+rpc_batch_timeout = int(os.environ.get('RPC_BATCH_TIMEOUT', 30)) # seconds to wait for a single batch response
+
+request_ids = itertools.count()
+
+
+class BatchRequestError(Exception):
+    pass
+
+
+def batch_request(endpoint_uri, calls, chunk_size=None):
+    """Sends a list of (method, params) calls to endpoint_uri as JSON-RPC batch
+    requests of at most chunk_size calls each, every call counting against the
+    rpc budget of the chain. Returns the list of results in the same order as
+    calls, raises BatchRequestError if any call failed."""
+    chunk_size = chunk_size or rpc_batch_size or len(calls)
+    chain = chains.get(endpoint_uri, endpoint_uri)
+    results = []
+    for start in range(0, len(calls), chunk_size):
+        chunk = calls[start:start + chunk_size]
+        payload = [{'jsonrpc': '2.0', 'id': next(request_ids), 'method': method, 'params': params} for method, params in chunk]
+        spend(chain, len(chunk))
+        for method, count in Counter(method for method, params in chunk).items():
+            rpc_calls_total.inc(chain, method, amount=count)
+        with rpc_request_seconds.time(chain, 'batch'):
+            response = get_session(endpoint_uri).post(endpoint_uri, data=json.dumps(payload), headers={'Content-Type': 'application/json'},
+                                    timeout=rpc_batch_timeout)
+        response.raise_for_status()
+        replies = response.json()
+        if not isinstance(replies, list):
+            # nodes which don't support batching reply with a single error object
+            raise BatchRequestError(f'batch request not supported by node: {replies}')
+        # responses to a batch may arrive in any order, match them back up by id
+        replies = {reply.get('id'): reply for reply in replies}
+        for call in payload:
+            reply = replies.get(call['id'])
+            if reply is None or 'error' in reply:
+                raise BatchRequestError(f'{call["method"]} {call["params"]} failed: {reply}')
+            results.append(reply['result'])
+    return results
@@ -0,0 +1,153 @@
+import os
+import time
+import json
+import heapq
+import itertools
+import threading
+from util.metrics import Histogram, Counter
+
+# callers of the same chain's node are served in this order when its rpc budget runs out
+priorities = {'deposits': 0, 'api': 1, 'prices': 2}
+default_priority = 'api' # of threads which never called set_priority, e.g. the api request threads
+
+# read only methods whose identical in-flight calls are sent to the node once
+coalesced_methods = {'eth_call', 'eth_getBalance', 'eth_blockNumber', 'eth_getBlockByNumber', 'eth_getLogs', 'eth_getCode', 'eth_chainId'}
+
+rpc_budget_wait_seconds = Histogram('rpc_budget_wait_seconds', 'Time rpc calls waited for the rpc budget of their chain', ['chain', 'priority'])
+rpc_coalesced_calls_total = Counter('rpc_coalesced_calls_total', 'Rpc calls answered by an identical call already in flight', ['chain', 'method'])
+
+local = threading.local()
+lock = threading.Lock()
+budgets = {} # evm => TokenBucket
+shares = {} # evm => share of <EVM>_RPC_RATE and _BURST this process gets, 1 when not set
+coalescers = {} # evm => Coalescer
+
+
+def set_priority(name):
+    """Sets the priority of the rpc calls made by the current thread."""
+    local.priority = name
+
+
+def get_priority():
+    return getattr(local, 'priority', default_priority)
+
+
+class TokenBucket:
+    """Rpc budget of one node: rate calls per second on average, with bursts of up
+    to burst calls. Callers that find the bucket empty queue up and are served by
+    priority, then in arrival order. A call costing more than burst, like a big
+    batch request, waits for a full bucket and leaves it in debt."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+        self.waiters = [] # heap of (priority, arrival) of the queued callers
+        self.arrivals = itertools.count()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    # blocks until cost tokens were taken, returns the seconds waited
+    def acquire(self, cost=1, priority=None):
+        start = time.monotonic()
+        ticket = (priorities[priority or get_priority()], next(self.arrivals))
+        needed = min(cost, self.burst)
+        with self.condition:
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    self.refill()
+                    if self.waiters[0] == ticket and self.tokens >= needed:
+                        heapq.heappop(self.waiters)
+                        self.tokens -= cost
+                        self.condition.notify_all() # the next caller in line is now first
+                        return time.monotonic() - start
+                    # the first caller sleeps until its tokens are refilled, the others until it is served
+                    self.condition.wait((needed - self.tokens) / self.rate if self.waiters[0] == ticket else None)
+            except BaseException:
+                if ticket in self.waiters:
+                    self.waiters.remove(ticket)
+                    heapq.heapify(self.waiters)
+                    self.condition.notify_all()
+                raise
+
+
+class InFlightCall:
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class Coalescer:
+    """Sends identical concurrent rpc calls to the node once: a call with the same
+    method and params as a call still in flight waits for that call and gets its
+    response, e.g. the same getReserves at the same block from two price readers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {} # (method, params json) => InFlightCall
+
+    # returns the response of make_request(method, params), or of the identical call in flight
+    def request(self, method, params, make_request):
+        key = (method, json.dumps(params, sort_keys=True, default=str))
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = InFlightCall()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return dict(call.response)
+        try:
+            call.response = make_request(method, params)
+            return call.response
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call.done.set()
+
+
+def get_budget(evm):
+    """Returns the TokenBucket of the node of evm ('eth', 'avax' or 'nevm') set by
+    <EVM>_RPC_RATE and <EVM>_RPC_BURST, or None when its calls are not limited.
+    Budgets are kept per process, each process gets its share of the rate."""
+    with lock:
+        if evm not in budgets:
+            share = shares.get(evm, 1)
+            rate = float(os.environ.get(f'{evm.upper()}_RPC_RATE', 0)) * share # max average rpc calls per second to the node of evm, 0 for no limit
+            burst = float(os.environ.get(f'{evm.upper()}_RPC_BURST', 0)) * share # max rpc calls sent at once after an idle period, defaults to one second of rate
+            budgets[evm] = TokenBucket(rate, burst) if rate > 0 else None
+        return budgets[evm]
+
+
+# gives this process share (0 < share <= 1) of the rpc budget of evm, e.g. when its deposit detection runs in a chain worker process
+def set_share(evm, share):
+    with lock:
+        shares[evm] = share
+        budgets.pop(evm, None) # rebuilt with the new share on next use
+
+
+def get_coalescer(evm):
+    with lock:
+        return coalescers.setdefault(evm, Coalescer())
+
+
+# waits for cost calls of the rpc budget of evm, if it has one
+def spend(evm, cost=1):
+    budget = get_budget(evm)
+    if budget is not None:
+        priority = get_priority()
+        rpc_budget_wait_seconds.observe(budget.acquire(cost, priority), evm, priority)
@@ -0,0 +1,23 @@
+from database.models import CoinPrice, db_session
+from util.price_oracle import PriceSnapshot
+from util.metrics import db_session_seconds
+
+
+# writes the prices of snapshot to the db, for the server processes which don't query the price sources
+@db_session_seconds.time('price_save')
+@db_session
+def save_prices(snapshot):
+    for coin_name, price in snapshot.prices.items():
+        row = CoinPrice.get(coin=coin_name)
+        if row is None:
+            row = CoinPrice(coin=coin_name, price=price, updated=snapshot.times[coin_name])
+        row.price = price
+        row.updated = snapshot.times[coin_name]
+
+
+# returns the PriceSnapshot last written by save_prices; its fetch times make prices go stale while no process saves them
+@db_session_seconds.time('price_load')
+@db_session
+def load_prices():
+    rows = CoinPrice.select()[:]
+    return PriceSnapshot({row.coin: row.price for row in rows}, {row.coin: row.updated for row in rows})
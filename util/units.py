@@ -0,0 +1,24 @@
+from decimal import Decimal
+
+# decimals of the evm native coins and block tokens; balances are credited in integer base units (wei for the native coins),
+# float amounts are only used in api responses
+coin_decimals = {
+        'eth': 18,
+        'ablock': 8,
+        'avax': 18,
+        'aablock': 8,
+        'sys': 18,
+        'sysblock': 8
+        }
+
+
+# returns the float amount of raw base units of coin_name
+def to_amount(raw, coin_name):
+    return raw / 10**coin_decimals[coin_name]
+
+
+# returns the integer base units of an amount of coin_name, exact for the amount's decimal representation; None stays None
+def to_raw(amount, coin_name):
+    if amount is None:
+        return None
+    return int(Decimal(str(amount)).scaleb(coin_decimals[coin_name]))